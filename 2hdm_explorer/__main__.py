@@ -1,15 +1,23 @@
 #!/bin/env python3
+import argparse
 import pickle
 from re import findall
 
 import coffea.processor as processor
 import numpy as np
 from coffea import hist
+from coffea.processor.executor import ResultStore
 
 from .dataset_finder import get_datasets, locate_root_files
 from .util import CMSPreliminary
 from .workspace import MonoZMuMuProducer
 
+parser = argparse.ArgumentParser("python -m 2hdm_explorer")
+parser.add_argument('--checkpoint', type=str, default=None,
+                    help="directory where the output of each chunk is saved, to resume an interrupted run")
+parser.add_argument('--checkpoint-gb', dest='checkpoint_gb', type=float, default=10.,
+                    help="size of the checkpoint directory in GB beyond which the oldest outputs are removed")
+
 
 def variable_histogram_plot(kind):
     def generic(cat, bins, s=None):
@@ -133,6 +141,7 @@ def plot_efficiency_MT(cat, s):
 
 
 if __name__ == '__main__':
+    options = parser.parse_args()
     locate_root_files()
     datasets = get_datasets()
     try:
@@ -144,8 +153,11 @@ if __name__ == '__main__':
             treename='Events',
             processor_instance=MonoZMuMuProducer(),
             executor=processor.futures_executor,
-            executor_args={'workers': 10},
-            chunksize=500000
+            executor_args={'workers': 10, 'treereduction': 10},
+            chunksize=500000,
+            metadata_cache='metadata.sqlite',
+            checkpoint=(ResultStore(options.checkpoint, maxbytes=int(options.checkpoint_gb * 1e9))
+                        if options.checkpoint else None)
         )
         with open('output.pkl', 'wb') as f:
             pickle.dump(output, f)
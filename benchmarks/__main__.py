@@ -0,0 +1,40 @@
+#!/bin/env python3
+"""
+Offline benchmarks of the MonoZ workspace production on synthetic NanoAOD-like files.
+"""
+import argparse
+import time
+
+from coffea.processor.executor import WorkItem
+
+from .suite import producer, bench_chunks, bench_weighting, bench_passbut, bench_accumulator, bench_jobs
+from .synthetic import generate
+
+parser = argparse.ArgumentParser("python -m benchmarks")
+parser.add_argument('--events', type=int, default=500000, help="entries of each synthetic file")
+parser.add_argument('--files', type=int, default=2, help="number of synthetic files")
+parser.add_argument('--chunksize', type=int, default=100000, help="entries of each chunk")
+parser.add_argument('--workers', type=int, default=4, help="workers of the parallel executors")
+parser.add_argument('--repeat', type=int, default=5, help="repetitions of the micro-benchmarks")
+parser.add_argument('--outdir', type=str, default='benchmark_data', help="directory of the synthetic files and outputs")
+parser.add_argument('--no-jobs', dest='jobs', action='store_false', help="skip the full run_uproot_job benchmarks")
+
+
+def main(options):
+    instance = producer(options.outdir)
+    print(instance)
+    tic = time.time()
+    files = generate(options.outdir, instance, options.files, options.events)
+    print(f'{len(files)} files of {options.events} entries and {len(instance.columns)} columns '
+          f'ready in {time.time() - tic:.1f} s')
+    item = WorkItem('Synthetic', files[0], 'Events', 0, min(options.chunksize, options.events))
+    bench_chunks(files, instance, options.chunksize)
+    bench_weighting(item, instance, options.repeat)
+    bench_passbut(item, instance, options.repeat)
+    bench_accumulator(item, instance, options.repeat)
+    if options.jobs:
+        bench_jobs(files, options.outdir, options.chunksize, options.workers)
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
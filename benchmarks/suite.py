@@ -0,0 +1,179 @@
+"""
+suite.py
+Benchmarks of the MonoZ workspace production: chunk processing by stage, weighting, passbut,
+accumulator handling and full jobs with each executor.
+"""
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import time
+
+import lz4.frame
+import numpy as np
+import uproot
+from coffea.processor import run_uproot_job, iterative_executor, futures_executor, dask_executor, LazyDataFrame
+from coffea.processor.executor import WorkItem, _work_function, _prefetch, stage_report, _Payload, _AdaptiveCompression
+
+from WSProducer import MonoZ
+from .synthetic import systematics
+
+
+def producer(outdir):
+    return MonoZ(isMC=1, era=2018, do_syst=1, syst_var='', sample='Synthetic',
+                 haddFileName=os.path.join(outdir, 'benchmark_WS.root'), systematics=systematics())
+
+
+def peak_memory():
+    """Peak resident memory in MB of this process plus the largest of its waited-for children."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def best(function, repeat):
+    """Smallest wall time of repeat calls of function, and its last result."""
+    times = []
+    for _ in range(repeat):
+        tic = time.time()
+        result = function()
+        times.append(time.time() - tic)
+    return min(times), result
+
+
+def chunk_dataframe(item, instance):
+    """A LazyDataFrame of a work item with the declared columns of instance read, as _work_function does."""
+    tree = uproot.open(item.filename)[item.treename]
+    df = LazyDataFrame(tree, item.numentries, 0)
+    df._branchargs.update(entrystart=item.entrystart, entrystop=item.entrystop)
+    _prefetch(df, tree, instance.columns)
+    return df
+
+
+def bench_chunks(files, instance, chunksize):
+    print(f'\n== process by chunk ({chunksize} entries)')
+    stages, entries, total = None, 0, 0.
+    for filename in files:
+        nentries = uproot.numentries(filename, 'Events')
+        for start in range(0, nentries, chunksize):
+            item = WorkItem('Synthetic', filename, 'Events', start, min(start + chunksize, nentries))
+            tic = time.time()
+            metrics = _work_function(item, instance, savemetrics=True)['metrics']
+            total += time.time() - tic
+            entries += item.numentries
+            if stages is None:
+                stages = metrics
+            else:
+                stages.add(metrics)
+    print(f'{entries} entries in {total:.3f} s: {entries / total:.0f} events/s')
+    print(stage_report(stages))
+
+
+def bench_weighting(item, instance, repeat):
+    print('\n== weighting')
+    df = chunk_dataframe(item, instance)
+    table = instance.weight_table
+    table.resolve(df, (item.filename, item.treename))
+
+    def nominal():
+        table._nominal = None
+        return instance.weighting(df)
+
+    t, _ = best(nominal, repeat)
+    print('%-32s %10.3f ms %12.0f events/s' % ('nominal', t * 1e3, df.size / t))
+    for producer in instance.variations:
+        if producer.weight_syst:
+            # the variations share the nominal weight of the chunk, as in process
+            t, _ = best(lambda: producer.weighting(df), repeat)
+            print('%-32s %10.3f ms %12.0f events/s' % (producer.syst_var, t * 1e3, df.size / t))
+
+
+def bench_passbut(item, instance, repeat):
+    print('\n== passbut (no cached cuts)')
+    df = chunk_dataframe(item, instance)
+
+    def passbut(region, excut):
+        instance.cuts.release()
+        return instance.passbut(df, excut, region)
+
+    # each region is filled without the cuts on the histogrammed target
+    regions = sorted({(region, hist['target']) for hist in instance.histograms.values() for region in hist['region']})
+    for region, excut in regions:
+        t, mask = best(lambda: passbut(region, excut), repeat)
+        print('%-32s %10.3f ms %12.0f events/s %8d selected' % (
+            f"{region} but {excut}", t * 1e3, df.size / t, np.count_nonzero(mask)))
+    instance.cuts.release()
+
+
+def bench_accumulator(item, instance, repeat):
+    print('\n== accumulator')
+    out = _work_function(item, instance)['out']
+    total = out.identity()
+    t, _ = best(lambda: total.add(out), repeat)
+    print('%-32s %10.3f ms' % ('add', t * 1e3))
+    t, blob = best(lambda: pickle.dumps(out, protocol=pickle.HIGHEST_PROTOCOL), repeat)
+    print('%-32s %10.3f ms %12d bytes' % ('pickle', t * 1e3, len(blob)))
+    t, compressed = best(lambda: lz4.frame.compress(blob), repeat)
+    print('%-32s %10.3f ms %12d bytes' % ('lz4', t * 1e3, len(compressed)))
+    t, _ = best(lambda: pickle.loads(lz4.frame.decompress(compressed)), repeat)
+    print('%-32s %10.3f ms' % ('lz4 + unpickle', t * 1e3))
+    # the executors' payloads: out-of-band buffers, compressed when it pays off
+    t, payload = best(lambda: pickle.dumps(_Payload.dump(out, _AdaptiveCompression(1))), repeat)
+    print('%-32s %10.3f ms %12d bytes' % ('payload + pickle', t * 1e3, len(payload)))
+    t, _ = best(lambda: pickle.loads(payload).load(), repeat)
+    print('%-32s %10.3f ms' % ('unpickle + payload', t * 1e3))
+
+
+def _run_job(connection, files, outdir, executor, executor_args, chunksize):
+    instance = producer(outdir)
+    client = None
+    if executor is dask_executor:
+        from distributed import Client, LocalCluster
+        client = Client(LocalCluster(n_workers=executor_args.pop('workers'), threads_per_worker=1))
+        executor_args = dict(executor_args, client=client)
+    tic = time.time()
+    output, metrics = run_uproot_job({'Synthetic': files}, 'Events', instance, executor, executor_args,
+                                     chunksize=chunksize)
+    elapsed = time.time() - tic
+    if client is not None:
+        client.close()
+        client.cluster.close()
+    connection.send((elapsed, metrics['entries'].value, peak_memory()))
+    connection.close()
+
+
+def bench_jobs(files, outdir, chunksize, workers):
+    print('\n== run_uproot_job')
+    jobs = [
+        ('iterative', iterative_executor, {}),
+        ('futures', futures_executor, {'workers': workers}),
+        ('futures treereduction', futures_executor, {'workers': workers, 'treereduction': 4}),
+        ('futures affinity', futures_executor, {'workers': workers, 'affinity': True}),
+        ('futures pipeline', futures_executor, {'workers': workers, 'pipeline': 4}),
+    ]
+    if sys.version_info >= (3, 8):
+        jobs.append(('futures sharedmemory', futures_executor, {'workers': workers, 'sharedmemory': True}))
+    try:
+        import distributed  # noqa: F401
+        jobs.append(('dask', dask_executor, {'workers': workers}))
+        jobs.append(('dask locality', dask_executor, {'workers': workers, 'locality': True}))
+    except ImportError:
+        print('distributed is not installed, skipping the dask executor')
+    print('%-24s %10s %14s %12s' % ('executor', 'time (s)', 'events/s', 'peak MB'))
+    # a fresh process per job, so that each has its own peak memory
+    context = multiprocessing.get_context('spawn')
+    for name, executor, executor_args in jobs:
+        receiver, sender = context.Pipe(duplex=False)
+        job = context.Process(target=_run_job, args=(sender, files, outdir, executor,
+                                                     dict(executor_args, savemetrics=True), chunksize))
+        job.start()
+        sender.close()
+        try:
+            elapsed, entries, memory = receiver.recv()
+        except EOFError:
+            elapsed = None
+        job.join()
+        if elapsed is None:
+            print('%-24s failed with exit code %s' % (name, job.exitcode))
+            continue
+        print('%-24s %10.3f %14.0f %12.1f' % (name, elapsed, entries / elapsed, memory))
@@ -0,0 +1,118 @@
+"""
+synthetic.py
+Synthetic NanoAOD-like Events and Runs trees with the branches read by a WSProducer.
+"""
+import os
+import re
+
+import numpy as np
+import uproot
+
+# systematics run by condor_coffea_WS.py
+PRO_SYST = ["ElectronEn", "MuonEn", "jesTotal", "jer"]
+EXT_SYST = ["puWeight", "PDF", "MuonSF", "ElecronSF", "EWK", "nvtxWeight", "TriggerSFWeight", "btagEventWeight",
+            "QCDScale0w", "QCDScale1w", "QCDScale2w"]
+
+
+def systematics(pro_syst=PRO_SYST, ext_syst=EXT_SYST):
+    """The (syst_var, weight_syst) list of a full MonoZ job."""
+    return ([(sys + var, False) for sys in pro_syst for var in ["Up", "Down"]]
+            + [(sys + var, True) for sys in ext_syst for var in ["Up", "Down"]])
+
+
+def _uniform_phi(rng, n):
+    return rng.uniform(-np.pi, np.pi, n)
+
+
+# samplers of the kinematic branches, by name without the systematic suffix
+KINEMATICS = {
+    'Z_pt': lambda rng, n: 20 + rng.exponential(60., n),
+    'Z_mass': lambda rng, n: 91.1876 + 2.4952 / 2 * rng.standard_cauchy(n).clip(-40, 40),
+    'Z_phi': _uniform_phi,
+    'met_pt': lambda rng, n: rng.exponential(50., n),
+    'emulatedMET': lambda rng, n: rng.exponential(70., n),
+    'emulatedMET_phi': _uniform_phi,
+    'MT': lambda rng, n: 50 + rng.exponential(150., n),
+    'sca_balance': lambda rng, n: rng.normal(1., 0.3, n).clip(0),
+    'delta_phi_ZMet': _uniform_phi,
+    'delta_phi_j_met': _uniform_phi,
+    'delta_R_ll': lambda rng, n: rng.uniform(0., 4., n),
+    'mass_alllep': lambda rng, n: 50 + rng.exponential(100., n),
+    'ngood_jets': lambda rng, n: rng.poisson(1., n).astype(np.int32),
+    'ngood_bjets': lambda rng, n: rng.poisson(.3, n).astype(np.int32),
+    'nhad_taus': lambda rng, n: rng.poisson(.1, n).astype(np.int32),
+    'lep_category': lambda rng, n: rng.randint(1, 8, n).astype(np.int32),
+}
+
+
+def branches(producer):
+    """Every branch a producer can read: cut and histogram columns, and all weight branches."""
+    names = set(producer.columns)
+    if producer.weight_table is not None:
+        names.update(branch for component in producer.weight_table.components.values()
+                     for direction, branch in component.items() if direction != 'optional')
+    return sorted(names)
+
+
+def sample(name, rng, n, nominal=None):
+    """Values of a branch: kinematics by name, weights around 1 (their variations around nominal)."""
+    base = re.sub(r'_sys_.*$', '', name)
+    if base in KINEMATICS:
+        return KINEMATICS[base](rng, n)
+    if name == 'xsecscale':
+        return np.full(n, 1e-3)
+    if nominal is not None:
+        sign = -1 if 'Down' in name else 1
+        return nominal * (1 + sign * np.abs(rng.normal(0., .03, n)))
+    return rng.normal(1., .05, n)
+
+
+def _nominal_branch(name, names):
+    """The nominal weight branch a variation branch shifts, if any."""
+    for suffix in ('_Up', '_Down', 'Up', 'Down'):
+        if name.endswith(suffix) and name[:-len(suffix)] in names:
+            return name[:-len(suffix)]
+    return None
+
+
+def write_file(path, producer, nevents, seed=0, basket=10000):
+    """Write Events (nevents, in baskets of basket entries) and Runs trees for producer to path."""
+    names = branches(producer)
+    rng = np.random.RandomState(seed)
+    with uproot.recreate(path) as f:
+        dtypes = {name: 'int32' if name.split('_sys_')[0] in ('ngood_jets', 'ngood_bjets', 'nhad_taus', 'lep_category')
+                  else 'float32' for name in names}
+        f['Events'] = uproot.newtree(dtypes)
+        sumw = 0.
+        for start in range(0, nevents, basket):
+            n = min(basket, nevents - start)
+            arrays = {}
+            for name in names:
+                if _nominal_branch(name, names) is None:
+                    arrays[name] = sample(name, rng, n)
+            for name in names:
+                nominal = _nominal_branch(name, names)
+                if nominal is not None:
+                    arrays[name] = sample(name, rng, n, arrays[nominal])
+            f['Events'].extend({name: array.astype(dtypes[name]) for name, array in arrays.items()})
+            sumw += float(np.sum(rng.normal(1., .05, n)))
+        f['Runs'] = uproot.newtree({'genEventSumw': 'float64'})
+        f['Runs'].extend({'genEventSumw': np.array([sumw])})
+    return path
+
+
+def generate(directory, producer, nfiles=2, nevents=500000, seed=0, basket=10000):
+    """
+    Write nfiles synthetic files of nevents each in directory, unless they already exist.
+    Returns the list of paths.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(nfiles):
+        path = os.path.join(directory, f'synthetic_{producer.__class__.__name__}_{nevents}_{seed + i}.root')
+        if not os.path.exists(path):
+            write_file(path + '.tmp', producer, nevents, seed + i, basket)
+            os.replace(path + '.tmp', path)
+        paths.append(path)
+    return paths
@@ -91,29 +91,16 @@ pro_syst = ["ElectronEn", "MuonEn", "jesTotal", "jer"]
 ext_syst = ["puWeight", "PDF", "MuonSF", "ElecronSF", "EWK", "nvtxWeight", "TriggerSFWeight", "btagEventWeight",
             "QCDScale0w", "QCDScale1w", "QCDScale2w"]
 
+systematics = []
+if options.isMC and options.doSyst == 1:
+    # all variations are filled in a single pass over the input by the nominal producer
+    systematics += [(sys + var, False) for sys in pro_syst for var in ["Up", "Down"]]
+    systematics += [(sys + var, True) for sys in ext_syst for var in ["Up", "Down"]]
+
 modules_era = []
 
 modules_era.append(MonoZ(isMC=options.isMC, era=int(options.era), do_syst=1, syst_var='', sample=options.dataset,
-                         haddFileName="tree_%s.root" % str(options.jobNum)))
-
-for sys in pro_syst:
-    for var in ["Up", "Down"]:
-        # modules_era.append(MonoZProducer(options.isMC, str(options.era), do_syst=1, syst_var=sys+var))
-        modules_era.append(MonoZ(options.isMC, str(options.era), do_syst=1,
-                                 syst_var=sys + var, sample=options.dataset,
-                                 haddFileName=f"tree_{options.jobNum}_{sys}{var}.root"))
-
-for sys in ext_syst:
-    for var in ["Up", "Down"]:
-        modules_era.append(
-            MonoZ(
-                options.isMC, str(options.era),
-                do_syst=1, syst_var=sys + var,
-                weight_syst=True,
-                sample=options.dataset,
-                haddFileName=f"tree_{options.jobNum}_{sys}{var}.root",
-            )
-        )
+                         haddFileName="tree_%s.root" % str(options.jobNum), systematics=systematics))
 
 # aif options.isMC:
 #   modules_era.append(VBSProducer(isMC=options.isMC, era=str(options.era), do_syst=1, syst_var=''))
@@ -19,6 +19,7 @@ parser.add_argument('--doSyst', type=int, default=1, help="")
 parser.add_argument('--infile', type=str, default=None, help="")
 parser.add_argument('--dataset', type=str, default="X", help="")
 parser.add_argument('--nevt', type=str, default=-1, help="")
+parser.add_argument('--profile', type=str, default=None, help="write the merged cProfile statistics of the workers to this file")
 
 options = parser.parse_args()
 
@@ -95,48 +96,33 @@ pro_syst = ["ElectronEn", "MuonEn", "jesTotal", "jer"]
 ext_syst = ["puWeight", "PDF", "MuonSF", "ElecronSF", "EWK", "nvtxWeight", "TriggerSFWeight", "btagEventWeight",
             "QCDScale0w", "QCDScale1w", "QCDScale2w"]
 
+systematics = []
+if options.isMC and options.doSyst==1:
+   # all variations are filled in a single pass over the input by the nominal producer
+   systematics += [(sys + var, False) for sys in pro_syst for var in ["Up", "Down"]]
+   systematics += [(sys + var, True) for sys in ext_syst for var in ["Up", "Down"]]
+
 modules_era = []
 
 modules_era.append(MonoZ(isMC=options.isMC, era=int(options.era), do_syst=1, syst_var='', sample=options.dataset,
-                         haddFileName="tree_%s.root" % str(options.jobNum)))
-if options.isMC and options.doSyst==1:
-   for sys in pro_syst:
-       for var in ["Up", "Down"]:
-           # modules_era.append(MonoZProducer(options.isMC, str(options.era), do_syst=1, syst_var=sys+var))
-           modules_era.append(MonoZ(options.isMC, str(options.era), do_syst=1,
-                                    syst_var=sys + var, sample=options.dataset,
-                                    haddFileName=f"tree_{options.jobNum}_{sys}{var}.root"))
-   
-   for sys in ext_syst:
-       for var in ["Up", "Down"]:
-           modules_era.append(
-               MonoZ(
-                   options.isMC, str(options.era),
-                   do_syst=1, syst_var=sys + var,
-                   weight_syst=True,
-                   sample=options.dataset,
-                   haddFileName=f"tree_{options.jobNum}_{sys}{var}.root",
-               )
-           )
+                         haddFileName="tree_%s.root" % str(options.jobNum), systematics=systematics))
 
 for i in modules_era:
     print("modules : ", i)
 
 print("Selection : ", pre_selection)
 tstart = time.time()
-f = recreate("tree_%s_WS.root" % str(options.jobNum))
+outputs = []
 for instance in modules_era:
     output = run_uproot_job(
         {instance.sample: [options.infile]},
         treename='Events',
         processor_instance=instance,
         executor=futures_executor,
-        executor_args={'workers': 10},
+        executor_args={'workers': 10, 'profile': options.profile},
         chunksize=500000
     )
-    for h, hist in output.items():
-        f[h] = export1d(hist)
-        print(f'wrote {h} to tree_{options.jobNum}_WS.root')
+    outputs.append(output)
 
 modules_gensum = []
 
@@ -152,10 +138,9 @@ for instance in modules_gensum:
         executor_args={'workers': 10},
         chunksize=500000
     )
-    for h, hist in output.items():
-        f[h] = export1d(hist)
-        print(f'wrote {h} to tree_{options.jobNum}_WS.root')
+    outputs.append(output)
 
+write_histograms("tree_%s_WS.root" % str(options.jobNum), *outputs)
 
 elapsed = time.time() - tstart
 print ("elapsed time is:", elapsed)
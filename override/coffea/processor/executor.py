@@ -1,16 +1,29 @@
 from __future__ import print_function, division
 import concurrent.futures
 from functools import partial
-from itertools import repeat
+from contextlib import contextmanager
+from itertools import repeat, islice
 import time
+import os
+import json
+import sqlite3
 import uproot
 import pickle
 import sys
 import math
+import bisect
+import hashlib
+import inspect
+import threading
+import cProfile
+import pstats
 import copy
+import multiprocessing
 import cloudpickle
+import awkward
+import numpy as np
 from tqdm.auto import tqdm
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 from cachetools import LRUCache
 import lz4.frame as lz4f
 from .processor import ProcessorABC
@@ -19,19 +32,34 @@ from .accumulator import (
     value_accumulator,
     set_accumulator,
     dict_accumulator,
+    defaultdict_accumulator,
 )
 from .dataframe import (
     LazyDataFrame,
 )
 
 try:
-    from collections.abc import Mapping, Sequence
+    from collections.abc import Mapping, MutableMapping, Sequence
 except ImportError:
-    from collections import Mapping, Sequence
+    from collections import Mapping, MutableMapping, Sequence
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 
 _PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
+# pickle protocol 5 and its out-of-band buffers, from the pickle5 backport before python 3.8
+if sys.version_info >= (3, 8):
+    _pickle5 = pickle
+else:
+    try:
+        import pickle5 as _pickle5
+    except ImportError:
+        _pickle5 = None
+
 
 # instrument xrootd source
 if not hasattr(uproot.source.xrootd.XRootDSource, '_read_real'):
@@ -44,13 +72,15 @@ if not hasattr(uproot.source.xrootd.XRootDSource, '_read_real'):
 
 
 class FileMeta(object):
-    __slots__ = ['dataset', 'filename', 'treename', 'numentries']
+    __slots__ = ['dataset', 'filename', 'treename', 'numentries', 'clusters']
 
-    def __init__(self, dataset, filename, treename, numentries=None):
+    def __init__(self, dataset, filename, treename, numentries=None, clusters=None):
         self.dataset = dataset
         self.filename = filename
         self.treename = treename
         self.numentries = numentries
+        # last entry (exclusive) of each cluster of the tree, if known
+        self.clusters = clusters
 
     def __hash__(self):
         # As used to lookup numentries, no need for dataset
@@ -60,35 +90,333 @@ class FileMeta(object):
         # In case of hash collisions
         return self.filename == other.filename and self.treename == other.treename
 
-    def maybe_populate(self, cache):
-        if cache and self in cache:
-            self.numentries = cache[self]
+    @property
+    def metadata(self):
+        """The value stored in the metadata cache"""
+        if self.clusters is None:
+            return self.numentries
+        return {'numentries': self.numentries, 'clusters': self.clusters}
+
+    def maybe_populate(self, cache, clusters=False):
+        if cache is not None and self in cache:
+            metadata = cache[self]
+            if isinstance(metadata, Mapping):
+                self.numentries = metadata['numentries']
+                # an entry read with align_clusters must not align the chunks of a job without it
+                self.clusters = metadata['clusters'] if clusters else None
+            elif not clusters:
+                self.numentries = metadata
 
     @property
     def populated(self):
         return self.numentries is not None
 
-    def nchunks(self, target_chunksize):
+    def nchunks(self, target_chunksize, entrystart=0, entrystop=None):
         if not self.populated:
             raise RuntimeError
-        return max(round(self.numentries / target_chunksize), 1)
+        if entrystop is None:
+            entrystop = self.numentries
+        return max(round((entrystop - entrystart) / target_chunksize), 1)
+
+    def chunks(self, target_chunksize, entrystart=0, entrystop=None):
+        if entrystop is None:
+            entrystop = self.numentries
+        n = self.nchunks(target_chunksize, entrystart, entrystop)
+        actual_chunksize = math.ceil((entrystop - entrystart) / n)
+        edges = [entrystart + index * actual_chunksize for index in range(1, n)]
+        if self.clusters:
+            # move each edge to the nearest cluster boundary, so no basket is shared by two chunks
+            snapped = set()
+            for edge in edges:
+                i = bisect.bisect_left(self.clusters, edge)
+                boundary = min(self.clusters[max(i - 1, 0):i + 1], key=lambda b: abs(b - edge))
+                if entrystart < boundary < entrystop:
+                    snapped.add(boundary)
+            # few large clusters must not make chunks much larger than asked: a range over twice
+            # the chunk size is split at the last boundary below the chunk size, or at it if none
+            edges = []
+            start = entrystart
+            for stop in sorted(snapped) + [entrystop]:
+                while stop - start > 2 * actual_chunksize:
+                    i = bisect.bisect_right(self.clusters, start + actual_chunksize)
+                    boundary = self.clusters[i - 1] if i > 0 else start
+                    start = boundary if boundary > start else start + actual_chunksize
+                    edges.append(start)
+                edges.append(stop)
+                start = stop
+            edges.pop()
+        edges = [entrystart] + edges + [entrystop]
+        for start, stop in zip(edges[:-1], edges[1:]):
+            yield WorkItem(self.dataset, self.filename, self.treename, start, stop)
+
+
+class DiskMetadataCache(MutableMapping):
+    """A persistent (file, tree) metadata cache, shared across processes and runs
+
+    Entries are stored in a sqlite database at ``path``, keyed by filename and
+    treename along with the size and modification time of local files, so that
+    an entry becomes a miss once its file changes.  The database is opened in
+    write-ahead-log mode, so several processes on one node can read and write it
+    concurrently.
+
+    Parameters
+    ----------
+        path : str
+            Path of the sqlite database, created if it does not exist
+        timeout : float, optional
+            Seconds to wait for a concurrent writer to release the database (default 60)
+    """
+    def __init__(self, path, timeout=60.):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'timeout': self.timeout, '_conn': None, '_pid': None}
 
-    def chunks(self, target_chunksize):
-        n = self.nchunks(target_chunksize)
-        actual_chunksize = math.ceil(self.numentries / n)
-        for index in range(n):
-            yield WorkItem(self.dataset, self.filename, self.treename, actual_chunksize, index)
+    @property
+    def conn(self):
+        # a sqlite connection cannot be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            with self._conn:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                                   'filename TEXT, treename TEXT, size INTEGER, mtime REAL, value TEXT, '
+                                   'PRIMARY KEY (filename, treename))')
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _stamp(filename):
+        # remote files cannot be stat'ed cheaply, they are assumed immutable
+        try:
+            stat = os.stat(filename)
+        except (OSError, ValueError):
+            return -1, -1.
+        return stat.st_size, stat.st_mtime
+
+    def __getitem__(self, key):
+        row = self.conn.execute('SELECT size, mtime, value FROM metadata WHERE filename=? AND treename=?',
+                                (key.filename, key.treename)).fetchone()
+        if row is None or tuple(row[:2]) != self._stamp(key.filename):
+            raise KeyError(key)
+        return json.loads(row[2])
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, other=(), **kwargs):
+        if isinstance(other, Mapping):
+            other = other.items()
+        rows = [(key.filename, key.treename) + self._stamp(key.filename) + (json.dumps(value), )
+                for key, value in other]
+        # one transaction for the whole batch
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)', rows)
+
+    def __delitem__(self, key):
+        with self.conn:
+            cursor = self.conn.execute('DELETE FROM metadata WHERE filename=? AND treename=?',
+                                       (key.filename, key.treename))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for filename, treename in self.conn.execute('SELECT filename, treename FROM metadata').fetchall():
+            yield FileMeta(None, filename, treename)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
 
 
 class WorkItem(object):
-    __slots__ = ['dataset', 'filename', 'treename', 'chunksize', 'index']
+    __slots__ = ['dataset', 'filename', 'treename', 'entrystart', 'entrystop']
 
-    def __init__(self, dataset, filename, treename, chunksize, index):
+    def __init__(self, dataset, filename, treename, entrystart, entrystop):
         self.dataset = dataset
         self.filename = filename
         self.treename = treename
-        self.chunksize = chunksize
-        self.index = index
+        self.entrystart = entrystart
+        self.entrystop = entrystop
+
+    @property
+    def numentries(self):
+        return self.entrystop - self.entrystart
+
+
+class _ChunkBatch(WorkItem):
+    """Consecutive chunks of a file, processed by one work item to read each one ahead of the previous
+
+    The batch spans all the entries of its chunks, ``edges`` holds the boundaries between them.
+    """
+    __slots__ = ['edges']
+
+    def __init__(self, dataset, filename, treename, entrystart, entrystop, edges=()):
+        super(_ChunkBatch, self).__init__(dataset, filename, treename, entrystart, entrystop)
+        self.edges = tuple(edges)
+
+    def chunks(self):
+        edges = (self.entrystart,) + self.edges + (self.entrystop,)
+        return [WorkItem(self.dataset, self.filename, self.treename, start, stop)
+                for start, stop in zip(edges[:-1], edges[1:])]
+
+
+class _by_dataset(object):
+    """Key the output of a work function by the dataset of its item"""
+    def __init__(self, function):
+        self.function = function
+
+    # no @wraps due to pickle
+    def __call__(self, item):
+        dataset = item[0].dataset if isinstance(item, tuple) else item.dataset
+        return dict_accumulator({dataset: self.function(item)})
+
+
+def _adaptive_chunks(remaining, cost, chunktime, workers):
+    """Chunk the remaining entries of each file to take about chunktime seconds each
+
+    remaining is a list of ``(filemeta, entrystart)`` and cost maps each dataset to its
+    measured processing time per entry.  The chunks are ordered longest first, and the
+    last ``workers`` of them are split in four, so that the final wave is finer.
+    """
+    default = sum(cost.values()) / len(cost) if cost else 0.
+
+    def estimate(item):
+        return item.numentries * cost.get(item.dataset, default)
+
+    chunks = []
+    filemetas = {}
+    for filemeta, entrystart in remaining:
+        filemetas[filemeta.filename, filemeta.treename] = filemeta
+        if entrystart >= filemeta.numentries:
+            continue
+        percost = cost.get(filemeta.dataset, default)
+        size = max(int(chunktime / percost), 1) if percost > 0 else filemeta.numentries
+        chunks.extend(filemeta.chunks(size, entrystart))
+    chunks.sort(key=estimate, reverse=True)
+    ntail = min(workers, len(chunks))
+    tail = chunks[len(chunks) - ntail:]
+    del chunks[len(chunks) - ntail:]
+    for item in tail:
+        filemeta = filemetas[item.filename, item.treename]
+        chunks.extend(filemeta.chunks(math.ceil(item.numentries / 4), item.entrystart, item.entrystop))
+    return chunks
+
+
+def _batch_chunks(chunks, size):
+    """Group the consecutive chunks of each file in batches of at most size chunks
+
+    Batches are ordered by their first chunk, single chunks are left as they are.
+    """
+    runs = OrderedDict()
+    for position, chunk in enumerate(chunks):
+        runs.setdefault((chunk.dataset, chunk.filename, chunk.treename), []).append((chunk.entrystart, position, chunk))
+    batches = []
+    for (dataset, filename, treename), run in runs.items():
+        run.sort()
+        group = []
+        for entrystart, position, chunk in run + [(None, None, None)]:
+            if group and (chunk is None or len(group) == size or group[-1][2].entrystop != entrystart):
+                first, last = group[0][2], group[-1][2]
+                if len(group) == 1:
+                    batches.append((group[0][1], first))
+                else:
+                    edges = [c.entrystart for _, _, c in group[1:]]
+                    batch = _ChunkBatch(dataset, filename, treename, first.entrystart, last.entrystop, edges)
+                    batches.append((min(p for _, p, _ in group), batch))
+                group = []
+            if chunk is not None:
+                group.append((entrystart, position, chunk))
+    return [batch for _, batch in sorted(batches, key=lambda x: x[0])]
+
+
+class _Payload(object):
+    """A pickled accumulator, with the time it took to serialize
+
+    ``blocks`` holds the pickle stream followed by its out-of-band buffers (protocol 5),
+    so that numpy arrays are not copied into the stream, and ``compressed`` tells which
+    blocks are LZ4-compressed. Raw buffers are handed as such to the pickler that sends
+    the payload to another process, out-of-band if it supports them.
+    """
+    __slots__ = ['blocks', 'compressed', 'serializetime']
+
+    def __init__(self, blocks, compressed, serializetime):
+        self.blocks = blocks
+        self.compressed = compressed
+        self.serializetime = serializetime
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5 and _pickle5 is not None:
+            wrap = _pickle5.PickleBuffer
+        else:
+            # multiprocessing pipes use the default protocol, copy into a buffer the receiver can write
+            wrap = bytearray
+        blocks = [block if compressed or isinstance(block, bytes) else wrap(block)
+                  for block, compressed in zip(self.blocks, self.compressed)]
+        return _Payload, (blocks, self.compressed, self.serializetime)
+
+    @classmethod
+    def dump(cls, out, compress):
+        tic = time.time()
+        buffers = []
+        if _pickle5 is None:
+            header = pickle.dumps(out, protocol=_PICKLE_PROTOCOL)
+        else:
+            header = _pickle5.dumps(out, protocol=5, buffer_callback=buffers.append)
+        blocks, compressed = zip(*(compress(block) for block in [header] + [b.raw() for b in buffers]))
+        return cls(list(blocks), list(compressed), time.time() - tic)
+
+    def load(self):
+        """The accumulator, whose arrays never share memory with the payload"""
+        blocks = []
+        for i, (block, compressed) in enumerate(zip(self.blocks, self.compressed)):
+            if compressed:
+                block = lz4f.decompress(block, return_bytearray=True)
+            elif i > 0:
+                # arrays are reduced in place, and the payload may be loaded again (e.g. a result
+                # dask still holds), so they cannot be backed by the payload's buffers
+                block = bytearray(block)
+            blocks.append(block)
+        if _pickle5 is None:
+            return pickle.loads(blocks[0])
+        return _pickle5.loads(blocks[0], buffers=blocks[1:])
+
+
+class _AdaptiveCompression(object):
+    """LZ4 compression of the blocks of payloads, when it pays off
+
+    Blocks smaller than ``threshold`` bytes are sent raw. Larger ones are compressed
+    unless the ratio observed lately is above ``maxratio``, in which case only one in
+    ``probe`` is, to notice when the outputs become compressible again.
+    """
+    def __init__(self, level, threshold=1 << 16, maxratio=0.8, probe=16):
+        self.level = level
+        self.threshold = threshold
+        self.maxratio = maxratio
+        self.probe = probe
+        self.ratio = None
+        self.skipped = 0
+
+    def __call__(self, block):
+        nbytes = memoryview(block).nbytes
+        if self.level is None or nbytes < self.threshold:
+            return block, False
+        if self.ratio is not None and self.ratio > self.maxratio:
+            self.skipped += 1
+            if self.skipped % self.probe:
+                return block, False
+        compressed = lz4f.compress(block, compression_level=self.level)
+        ratio = len(compressed) / nbytes
+        self.ratio = ratio if self.ratio is None else 0.75 * self.ratio + 0.25 * ratio
+        if len(compressed) >= nbytes:
+            return block, False
+        return compressed, True
+
+
+# compression policies by level, kept by each worker process across work items
+_compressions = {}
 
 
 class _compression_wrapper(object):
@@ -99,15 +427,24 @@ class _compression_wrapper(object):
     # no @wraps due to pickle
     def __call__(self, *args, **kwargs):
         out = self.function(*args, **kwargs)
-        return lz4f.compress(pickle.dumps(out, protocol=_PICKLE_PROTOCOL), compression_level=self.level)
+        if self.level not in _compressions:
+            _compressions[self.level] = _AdaptiveCompression(self.level)
+        return _Payload.dump(out, _compressions[self.level])
 
 
 def _maybe_decompress(item):
     if isinstance(item, AccumulatorABC):
         return item
+    serializetime = None
     try:
-        item = pickle.loads(lz4f.decompress(item))
+        if isinstance(item, _Payload):
+            item, serializetime = item.load(), item.serializetime
+        else:
+            item = pickle.loads(lz4f.decompress(item))
         if isinstance(item, AccumulatorABC):
+            # the serialization time is only known once the metrics are serialized
+            if serializetime is not None and isinstance(item, Mapping) and 'stagetime' in item.get('metrics', ()):
+                item['metrics']['stagetime']['serialize'] += serializetime
             return item
         raise RuntimeError
     except (RuntimeError, pickle.UnpicklingError):
@@ -121,23 +458,50 @@ def _iadd(output, result):
 def _reduce(items):
     if len(items) == 0:
         raise ValueError("Empty list provided to reduction")
-    # if dask has a cached result, we cannot alter it
-    out = copy.deepcopy(_maybe_decompress(items.pop()))
+    out = items.pop()
+    # a loaded payload is a fresh copy, but if dask has a cached accumulator, we cannot alter it
+    out = copy.deepcopy(out) if isinstance(out, AccumulatorABC) else _maybe_decompress(out)
     while items:
         out += _maybe_decompress(items.pop())
     return out
 
 
-def _futures_handler(futures_set, output, status, unit, desc, add_fn):
+def _futures_handler(futures_set, output, status, unit, desc, add_fn, total=None, refill=None,
+                     reduce=None, treereduction=None):
+    """Reduce each future's result into output as soon as it completes
+
+    If given, ``refill(done)`` is called with the set of item futures that just
+    finished, before their results are reduced, and returns a set of newly
+    submitted futures to keep the in-flight window full.
+
+    If given, ``reduce(results)`` submits the reduction of a list of results
+    and returns its future. Results are then merged by the workers in groups
+    of ``treereduction``, and only the last partial sums are added to output.
+    """
+    if total is None:
+        total = len(futures_set)
+    reductions = set()
+    results = []
     try:
-        with tqdm(disable=not status, unit=unit, total=len(futures_set), desc=desc) as pbar:
+        with tqdm(disable=not status, unit=unit, total=total, desc=desc) as pbar:
             while len(futures_set) > 0:
-                finished = set(job for job in futures_set if job.done())
+                finished, _ = concurrent.futures.wait(futures_set, return_when=concurrent.futures.FIRST_COMPLETED)
                 futures_set.difference_update(finished)
+                done = finished - reductions
+                reductions.difference_update(finished)
+                if refill is not None:
+                    futures_set.update(refill(done))
                 while finished:
-                    add_fn(output, finished.pop().result())
-                    pbar.update(1)
-                time.sleep(0.5)
+                    if reduce is None:
+                        add_fn(output, finished.pop().result())
+                    else:
+                        results.append(finished.pop().result())
+                pbar.update(len(done))
+                while reduce is not None and len(results) >= treereduction:
+                    job = reduce(results[:treereduction])
+                    del results[:treereduction]
+                    reductions.add(job)
+                    futures_set.add(job)
     except KeyboardInterrupt:
         for job in futures_set:
             job.cancel()
@@ -148,6 +512,180 @@ def _futures_handler(futures_set, output, status, unit, desc, add_fn):
         for job in futures_set:
             job.cancel()
         raise
+    while results:
+        add_fn(output, results.pop())
+
+
+def _affinity_key(item):
+    # dask joins items to the heavy input
+    if isinstance(item, tuple):
+        item = item[0]
+    return getattr(item, 'filename', None)
+
+
+def _assign_files(items, nlanes):
+    """Split items in nlanes queues, keeping the items of each file together
+
+    Files are assigned largest first to the queue with the fewest entries so far.
+    """
+    files = OrderedDict()
+    for item in items:
+        files.setdefault(_affinity_key(item), []).append(item)
+
+    def weight(group):
+        return sum(getattr(item[0] if isinstance(item, tuple) else item, 'numentries', None) or 1 for item in group)
+
+    queues = [deque() for _ in range(nlanes)]
+    loads = [0] * nlanes
+    for group in sorted(files.values(), key=weight, reverse=True):
+        lane = loads.index(min(loads))
+        queues[lane].extend(group)
+        loads[lane] += weight(group)
+    return queues
+
+
+class _AffinityScheduler(object):
+    """Submit the items of each file to the same single-worker executor (lane)
+
+    Each lane keeps at most ``depth`` items in flight.  A lane that runs out of
+    items steals the last file queued on the busiest lane, or the second half
+    of its items if it is the only file left there.
+    """
+    def __init__(self, lanes, items, function, depth):
+        self.lanes = lanes
+        self.queues = _assign_files(items, len(lanes))
+        self.function = function
+        self.depth = depth
+        self.inflight = [0] * len(lanes)
+        self.lane = {}
+
+    def steal(self, thief):
+        victim = max(range(len(self.queues)), key=lambda i: len(self.queues[i]))
+        queue = self.queues[victim]
+        if not queue:
+            return
+        last = _affinity_key(queue[-1])
+        stolen = deque()
+        while queue and _affinity_key(queue[-1]) == last:
+            stolen.appendleft(queue.pop())
+        if not queue:
+            for _ in range(len(stolen) // 2):
+                queue.append(stolen.popleft())
+        self.queues[thief].extend(stolen)
+
+    def refill(self, done):
+        for job in done:
+            self.inflight[self.lane.pop(job)] -= 1
+        futures = set()
+        for i, lane in enumerate(self.lanes):
+            while self.inflight[i] < self.depth:
+                if not self.queues[i]:
+                    self.steal(i)
+                if not self.queues[i]:
+                    break
+                job = lane.submit(self.function, self.queues[i].popleft())
+                self.lane[job] = i
+                self.inflight[i] += 1
+                futures.add(job)
+        return futures
+
+    def reduce(self, reducer, results):
+        lane = self.inflight.index(min(self.inflight))
+        return self.lanes[lane].submit(reducer, results)
+
+    def relocate(self, key, lane):
+        """Move the queued items of file key to lane, e.g. the one that ended up running another of them"""
+        for i, queue in enumerate(self.queues):
+            if i == lane:
+                continue
+            moved = [item for item in queue if _affinity_key(item) == key]
+            if moved:
+                self.queues[i] = deque(item for item in queue if _affinity_key(item) != key)
+                self.queues[lane].extendleft(reversed(moved))
+
+
+def _dataset(item):
+    if isinstance(item, tuple):
+        item = item[0]
+    return getattr(item, 'dataset', None)
+
+
+class _DaskLane(object):
+    """A dask worker as a lane of `_AffinityScheduler`, tasks submitted to it prefer that worker
+
+    The worker and item of every submitted task are recorded in ``submitted`` by task key.
+    """
+    def __init__(self, client, worker, priority, submitted):
+        self.client = client
+        self.worker = worker
+        self.priority = priority
+        self.submitted = submitted
+
+    def submit(self, function, item):
+        job = self.client.submit(function, item, workers=[self.worker], allow_other_workers=True,
+                                 priority=self.priority, pure=False)
+        self.submitted[job.key] = self.worker, item
+        return job
+
+
+def _dask_locality(client, items, function, reducer, accumulator, ntree, priority, status, unit, desc):
+    """Run items on the dask workers keeping files and the reductions of their outputs where they are
+
+    Files are assigned to workers as with affinity, and the queued items of a file follow it
+    to the worker that ran one of its items, e.g. after stealing it.  Outputs are merged in groups
+    of ``ntree`` of the same dataset on the worker that holds them, then the partial sums of each
+    worker on that worker, and only these are sent to the client.
+    """
+    from distributed import as_completed
+    info = client.scheduler_info()['workers']
+    workers = list(info)
+    submitted = {}
+    lanes = [_DaskLane(client, worker, priority, submitted) for worker in workers]
+    # enough queued tasks to keep every thread of a worker busy
+    depth = 2 * max(worker.get('nthreads', 1) for worker in info.values())
+    scheduler = _AffinityScheduler(lanes, items, function, depth)
+    held = defaultdict(list)  # (worker, dataset) -> futures of the outputs it holds
+    merging = {}  # reduction future -> dataset
+
+    def merge(worker, group):
+        return client.submit(reducer, group, workers=[worker], allow_other_workers=True, priority=priority,
+                             pure=False)
+
+    pending = as_completed(scheduler.refill(()))
+    try:
+        with tqdm(disable=not status, unit=unit, total=len(items), desc=desc) as pbar:
+            for batch in pending.batches():
+                locations = client.who_has(batch)
+                done = set()
+                for job in batch:
+                    if job.status == 'error':
+                        job.result()
+                    worker = locations[job.key][0]
+                    if job in merging:
+                        dataset = merging.pop(job)
+                    else:
+                        planned, item = submitted.pop(job.key)
+                        dataset = _dataset(item)
+                        if worker != planned and worker in workers:
+                            scheduler.relocate(_affinity_key(item), workers.index(worker))
+                        done.add(job)
+                    held[worker, dataset].append(job)
+                    if len(held[worker, dataset]) >= ntree:
+                        reduction = merge(worker, held.pop((worker, dataset)))
+                        merging[reduction] = dataset
+                        pending.add(reduction)
+                pending.update(scheduler.refill(done))
+                pbar.update(len(done))
+    except BaseException:
+        client.cancel(list(scheduler.lane) + list(merging))
+        raise
+    partials = defaultdict(list)
+    for (worker, dataset), jobs in held.items():
+        partials[worker].extend(jobs)
+    partials = [merge(worker, jobs) if len(jobs) > 1 else jobs[0] for worker, jobs in partials.items()]
+    for job in partials:
+        _iadd(accumulator, job.result())
+    return accumulator
 
 
 def iterative_executor(items, function, accumulator, **kwargs):
@@ -169,6 +707,7 @@ def iterative_executor(items, function, accumulator, **kwargs):
             Label of progress bar description
         compression : int, optional
             Compress accumulator outputs in flight with LZ4, at level specified (default 1)
+            Only large buffers are compressed, while the observed ratio is worth it.
             Set to ``None`` for no compression.
     """
     if len(items) == 0:
@@ -185,6 +724,97 @@ def iterative_executor(items, function, accumulator, **kwargs):
     return accumulator
 
 
+def _contents_leaves(accumulator, path=()):
+    """(path, accumulator) of every accumulator holding a numpy ``contents`` array, through mappings"""
+    if isinstance(getattr(accumulator, 'contents', None), np.ndarray):
+        yield path, accumulator
+    elif isinstance(accumulator, Mapping):
+        for key, value in accumulator.items():
+            for leaf in _contents_leaves(value, path + (key,)):
+                yield leaf
+
+
+class _SharedBlocks(object):
+    """One shared memory block per worker process, for the ``contents`` of an accumulator
+
+    ``layout`` lists the (path, offset, shape, dtype) of every ``contents`` array in a block.
+    Workers add the contents of their outputs to their own block instead of sending them,
+    and the blocks are summed into the accumulator once the workers are done.
+    """
+    def __init__(self, accumulator, nblocks):
+        self.layout = []
+        nbytes = 0
+        for path, leaf in _contents_leaves(accumulator):
+            self.layout.append((path, nbytes, leaf.contents.shape, leaf.contents.dtype.str))
+            nbytes += leaf.contents.nbytes
+        self.blocks = []
+        self.queue = multiprocessing.Queue()
+        if self.layout:
+            # new blocks are zero-filled
+            self.blocks = [shared_memory.SharedMemory(create=True, size=max(nbytes, 1)) for _ in range(nblocks)]
+            for block in self.blocks:
+                self.queue.put(block.name)
+
+    @property
+    def initializer(self):
+        """Keyword arguments of a process pool whose workers each take one block"""
+        return {'initializer': _attach_shared_block, 'initargs': (self.queue, self.layout)}
+
+    def collect(self, accumulator):
+        for path, offset, shape, dtype in self.layout:
+            leaf = accumulator
+            for key in path:
+                leaf = leaf[key]
+            for block in self.blocks:
+                leaf.contents += np.ndarray(shape, dtype, buffer=block.buf, offset=offset)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.queue.close()
+
+
+# the shared block of this worker process and its views by path, see _SharedBlocks
+_shared_block = None
+
+
+def _attach_shared_block(queue, layout):
+    global _shared_block
+    name = queue.get(timeout=60)
+    # pool workers share the resource tracker of the parent, which unlinks the block
+    block = shared_memory.SharedMemory(name=name)
+    views = {path: np.ndarray(shape, dtype, buffer=block.buf, offset=offset) for path, offset, shape, dtype in layout}
+    _shared_block = block, views
+
+
+class _shared_accumulation(object):
+    """Add the ``contents`` of the output of a work function to the shared block of the worker
+
+    The output is returned without them, so that only the rest (e.g. the metrics) is sent.
+    """
+    def __init__(self, function, layout):
+        self.function = function
+        self.layout = layout
+
+    # no @wraps due to pickle
+    def __call__(self, *args, **kwargs):
+        out = self.function(*args, **kwargs)
+        if _shared_block is None:
+            raise RuntimeError("Shared memory accumulation needs workers started with _attach_shared_block")
+        views = _shared_block[1]
+        for path, offset, shape, dtype in self.layout:
+            parent = out
+            for key in path[:-1]:
+                parent = parent[key]
+            contents = parent.pop(path[-1]).contents
+            if contents.shape != views[path].shape:
+                raise ValueError("Output contents of shape %r do not match the shared block %r"
+                                 % (contents.shape, views[path].shape))
+            views[path] += contents
+        return out
+
+
 def futures_executor(items, function, accumulator, **kwargs):
     """Execute using multiple local cores using python futures
 
@@ -201,6 +831,23 @@ def futures_executor(items, function, accumulator, **kwargs):
             You can pass an instance instead of a class to re-use an executor
         workers : int, optional
             Number of parallel processes for futures (default 1)
+        max_inflight : int, optional
+            Maximum number of items submitted to the pool at any time, new items are
+            submitted as others complete (default: 4 times the number of workers)
+        treereduction : int, optional
+            If set, output accumulators are merged in the pool in groups of this size
+            as they complete, and only the last partial sums are added in this process
+            (default: None, all outputs are added in this process)
+        affinity : bool, optional
+            If true, run one single-worker pool per worker and send all the items of a file
+            to the same one, so that its open file and caches are reused.  A worker with no
+            items left takes over files queued on the busiest one (default False).
+            Needs a pool class rather than an instance.
+        sharedmemory : bool, optional
+            If true, every worker process adds the numpy ``contents`` of its outputs (e.g. of a
+            block of histograms) to its own block of shared memory, only the rest of the outputs
+            (e.g. the metrics) is sent back, and the blocks are summed once all items are done.
+            Needs python 3.8, and a process pool class rather than an instance (default False).
         status : bool, optional
             If true (default), enable progress bar
         unit : str, optional
@@ -209,6 +856,7 @@ def futures_executor(items, function, accumulator, **kwargs):
             Label of progress bar description (default: 'items')
         compression : int, optional
             Compress accumulator outputs in flight with LZ4, at level specified (default 1)
+            Only large buffers are compressed, while the observed ratio is worth it.
             Set to ``None`` for no compression.
     """
     if len(items) == 0:
@@ -218,18 +866,70 @@ def futures_executor(items, function, accumulator, **kwargs):
     status = kwargs.pop('status', True)
     unit = kwargs.pop('unit', 'items')
     desc = kwargs.pop('desc', 'Processing')
+    ntree = kwargs.pop('treereduction', None)
+    affinity = kwargs.pop('affinity', False)
+    max_inflight = kwargs.pop('max_inflight', None)
+    sharedmemory = kwargs.pop('sharedmemory', False)
     clevel = kwargs.pop('compression', 1)
+    shared = None
+    pool_args = {}
+    if sharedmemory:
+        if shared_memory is None:
+            raise ValueError("Shared memory accumulation needs python 3.8 or later")
+        if isinstance(pool, concurrent.futures.Executor) or not issubclass(pool, concurrent.futures.ProcessPoolExecutor):
+            raise ValueError("Shared memory accumulation needs a process pool class, to set up its workers")
+        shared = _SharedBlocks(accumulator, workers)
+        # accumulators without numpy contents are sent as usual
+        if shared.layout:
+            function = _shared_accumulation(function, shared.layout)
+            pool_args = shared.initializer
+    reducer = _reduce
     if clevel is not None:
         function = _compression_wrapper(clevel, function)
+        reducer = _compression_wrapper(clevel, reducer)
     add_fn = _iadd
-    if isinstance(pool, concurrent.futures.Executor):
-        futures = set(pool.submit(function, item) for item in items)
-        _futures_handler(futures, accumulator, status, unit, desc, add_fn)
-    else:
-        # assume its a class then
-        with pool(max_workers=workers) as executor:
-            futures = set(executor.submit(function, item) for item in items)
-            _futures_handler(futures, accumulator, status, unit, desc, add_fn)
+
+    def run(executor):
+        nworkers = getattr(executor, '_max_workers', workers)
+        remaining = iter(items)
+
+        def refill(done):
+            n = (max_inflight or 4 * nworkers) if done is None else len(done)
+            return set(executor.submit(function, item) for item in islice(remaining, n))
+
+        reduce = partial(executor.submit, reducer) if ntree else None
+        _futures_handler(refill(None), accumulator, status, unit, desc, add_fn, total=len(items), refill=refill,
+                         reduce=reduce, treereduction=ntree)
+
+    def run_affinity(lanes):
+        depth = max((max_inflight or 4 * workers) // workers, 1)
+        scheduler = _AffinityScheduler(lanes, items, function, depth)
+        reduce = partial(scheduler.reduce, reducer) if ntree else None
+        _futures_handler(scheduler.refill(()), accumulator, status, unit, desc, add_fn, total=len(items),
+                         refill=scheduler.refill, reduce=reduce, treereduction=ntree)
+
+    try:
+        if affinity:
+            if isinstance(pool, concurrent.futures.Executor):
+                raise ValueError("File affinity needs a pool class, to start one single-worker pool per worker")
+            lanes = [pool(max_workers=1, **pool_args) for _ in range(workers)]
+            try:
+                run_affinity(lanes)
+            finally:
+                for lane in lanes:
+                    lane.shutdown()
+        elif isinstance(pool, concurrent.futures.Executor):
+            run(pool)
+        else:
+            # assume its a class then
+            with pool(max_workers=workers, **pool_args) as executor:
+                run(executor)
+        # the workers are done, their blocks are complete
+        if shared is not None:
+            shared.collect(accumulator)
+    finally:
+        if shared is not None:
+            shared.close()
     return accumulator
 
 
@@ -252,12 +952,26 @@ def dask_executor(items, function, accumulator, **kwargs):
             If true (default), enable progress bar
         compression : int, optional
             Compress accumulator outputs in flight with LZ4, at level specified (default 1)
+            Only large buffers are compressed, while the observed ratio is worth it.
             Set to ``None`` for no compression.
         priority : int, optional
             Task priority, default 0
+        unit : str, optional
+            Label of progress bar unit, with locality (default: 'items')
+        desc : str, optional
+            Label of progress bar description, with locality (default: 'Processing')
         heavy_input : serializable, optional
             Any value placed here will be broadcast to workers and joined to input
             items in a tuple (item, heavy_input) that is passed to function.
+        affinity : bool, optional
+            If true, all the items of a file are submitted to the same worker, files being
+            balanced across workers by entries.  Other workers may still steal them (default False)
+        locality : bool, optional
+            If true, items are submitted as workers complete them rather than all at once, files
+            being assigned as with affinity.  The remaining items of a file follow it to the worker
+            that ran one of them, and an idle worker takes over a file queued on the busiest one.
+            Outputs of the same dataset are merged by groups of ``treereduction`` on the worker that
+            holds them, and the partial sums of each worker on that worker (default False)
     """
     if len(items) == 0:
         return accumulator
@@ -267,6 +981,10 @@ def dask_executor(items, function, accumulator, **kwargs):
     clevel = kwargs.pop('compression', 1)
     priority = kwargs.pop('priority', 0)
     heavy_input = kwargs.pop('heavy_input', None)
+    affinity = kwargs.pop('affinity', False)
+    locality = kwargs.pop('locality', False)
+    unit = kwargs.pop('unit', 'items')
+    desc = kwargs.pop('desc', 'Processing')
     reducer = _reduce
     if clevel is not None:
         function = _compression_wrapper(clevel, function)
@@ -275,7 +993,17 @@ def dask_executor(items, function, accumulator, **kwargs):
     if heavy_input is not None:
         heavy_token = client.scatter(heavy_input, broadcast=True, hash=False)
         items = list(zip(items, repeat(heavy_token)))
-    futures = client.map(function, items, priority=priority)
+    if locality:
+        return _dask_locality(client, items, function, reducer, accumulator, ntree, priority, status, unit, desc)
+    if affinity:
+        workers = list(client.scheduler_info()['workers'])
+        futures = []
+        for worker, queue in zip(workers, _assign_files(items, len(workers))):
+            futures.extend(client.submit(function, item, workers=[worker], allow_other_workers=True,
+                                         priority=priority)
+                           for item in queue)
+    else:
+        futures = client.map(function, items, priority=priority)
     while len(futures) > 1:
         futures = client.map(
             reducer,
@@ -313,6 +1041,7 @@ def parsl_executor(items, function, accumulator, **kwargs):
             Label of progress bar description
         compression : int, optional
             Compress accumulator outputs in flight with LZ4, at level specified (default 1)
+            Only large buffers are compressed, while the observed ratio is worth it.
             Set to ``None`` for no compression.
     """
     if len(items) == 0:
@@ -355,11 +1084,285 @@ def parsl_executor(items, function, accumulator, **kwargs):
     return accumulator
 
 
-def _work_function(item, processor_instance, flatten=False, savemetrics=False, mmap=False):
-    if processor_instance == 'heavy':
-        item, processor_instance = item
-    if not isinstance(processor_instance, ProcessorABC):
-        processor_instance = cloudpickle.loads(lz4f.decompress(processor_instance))
+class ResultStore(object):
+    """A content-addressed store of chunk outputs, shared across runs
+
+    Outputs are saved in ``directory`` under a digest of the dataset, the identity of
+    the input file (name, and size and modification time if local), the tree name, the
+    entry range and a digest of the processor's state and code (see `_processor_digest`),
+    so a chunk is only processed again if one of them changed.  A file listed under
+    several datasets has an output for each.  Each output is written to a temporary file
+    which is then renamed, so an interrupted job never leaves a partial output behind.
+
+    Parameters
+    ----------
+        directory : str
+            Directory of the store, created if it does not exist; a relative path is made
+            absolute, so that workers with another working directory share it
+        maxbytes : int, optional
+            Once a run is over, the least recently used outputs are removed until the
+            store holds at most this many bytes (default None, no limit)
+
+    The ``hits`` and ``misses`` attributes count the outputs found and not found
+    by `restore`.
+    """
+    def __init__(self, directory, maxbytes=None):
+        self.directory = os.path.abspath(directory)
+        self.maxbytes = maxbytes
+        self.processor_digest = None
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def bind(self, processor_digest):
+        """A view of the store for the outputs of one processor"""
+        out = copy.copy(self)
+        out.processor_digest = processor_digest
+        out.hits = out.misses = 0
+        return out
+
+    def path(self, item):
+        size, mtime = DiskMetadataCache._stamp(item.filename)
+        key = repr((item.dataset, item.filename, size, mtime, item.treename, item.entrystart, item.entrystop,
+                    self.processor_digest))
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.coffea')
+
+    def load(self, item):
+        path = self.path(item)
+        try:
+            with open(path, 'rb') as fin:
+                output = _maybe_decompress(fin.read())
+        except (IOError, OSError):
+            return None
+        # the modification time orders the eviction
+        os.utime(path, None)
+        return output
+
+    def save(self, item, output):
+        path = self.path(item)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fout:
+            fout.write(lz4f.compress(pickle.dumps(output, protocol=_PICKLE_PROTOCOL)))
+        os.replace(tmp, path)
+
+    def restore(self, items):
+        """Split items in (item, saved output) pairs and items left to process"""
+        done, todo = [], []
+        for item in items:
+            output = self.load(item)
+            if output is None:
+                todo.append(item)
+            else:
+                done.append((item, output))
+        self.hits += len(done)
+        self.misses += len(todo)
+        return done, todo
+
+    def evict(self):
+        """Remove the least recently used outputs beyond maxbytes"""
+        if self.maxbytes is None:
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.coffea'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def _processor_digest(processor_instance):
+    """A digest of the state and the code of a processor, which its outputs are stored under
+
+    Classes defined in a module are pickled by reference, so the source of the modules of the
+    processor's classes is part of the digest, and editing them invalidates the outputs.  The
+    attributes named in the processor's ``checkpoint_exclude`` (e.g. output paths) are not.
+    """
+    state = copy.copy(processor_instance)
+    for name in getattr(processor_instance, 'checkpoint_exclude', ()):
+        getattr(state, '__dict__', {}).pop(name, None)
+    digest = hashlib.sha1(cloudpickle.dumps(state))
+    modules = []
+    for cls in type(processor_instance).__mro__:
+        module = sys.modules.get(cls.__module__)
+        if module is None or module in modules:
+            continue
+        modules.append(module)
+        try:
+            digest.update(inspect.getsource(module).encode())
+        except (OSError, TypeError):
+            # built-in or without source (e.g. defined interactively, then pickled by value)
+            pass
+    return digest.hexdigest()
+
+
+class _checkpointed(object):
+    """Save the output of a work function in a result store"""
+    def __init__(self, function, store):
+        self.function = function
+        self.store = store
+
+    # no @wraps due to pickle
+    def __call__(self, item, **kwargs):
+        out = self.function(item, **kwargs)
+        self.store.save(item[0] if isinstance(item, tuple) else item, out)
+        return out
+
+
+def _prefetch(df, tree, columns, flatten=False, columntime=None):
+    """Read every declared column of a chunk available in the tree in one request
+
+    If columntime is given, the columns are read one at a time, as uproot
+    does anyway, and the time each takes is added to it.
+    """
+    available = set(k.decode() if isinstance(k, bytes) else k for k in tree.keys())
+    # df._dict holds the columns already read, a plain `in df` would read them one by one
+    branches = [c for c in columns if c in available and c not in df._dict]
+    if columntime is None:
+        arrays = tree.arrays(branches, namedecode='utf-8', **df._branchargs)
+    else:
+        arrays = {}
+        for name in branches:
+            tic = time.time()
+            arrays[name] = tree[name].array(**df._branchargs)
+            columntime[name] += time.time() - tic
+    for name in branches:
+        array = arrays[name]
+        if flatten and isinstance(array, awkward.JaggedArray):
+            array = array.flatten()
+        df[name] = array
+    df.materialized.update(branches)
+
+
+def _branch_bytes(branch, entrystart, entrystop):
+    """Compressed size of the baskets of a branch overlapping an entry range
+
+    The baskets written with the branch are sized from its ``fBasketBytes``, which includes
+    their key headers, and located with its ``fBasketEntry`` edges without reading any key.
+    Only the baskets recovered from a file that was not closed are sized from their keys.
+    """
+    good = branch._numgoodbaskets
+    edges = np.asarray(branch._fBasketEntry[:good + 1])
+    first = max(int(np.searchsorted(edges, entrystart, side='right')) - 1, 0)
+    stop = min(int(np.searchsorted(edges, entrystop, side='left')), good)
+    nbytes = int(np.sum(np.asarray(branch._fBasketBytes[first:stop], dtype=np.int64))) if stop > first else 0
+    return nbytes + sum(branch.basket_compressedbytes(i) for i in range(good, branch.numbaskets)
+                        if branch.basket_entrystart(i) < entrystop and branch.basket_entrystop(i) > entrystart)
+
+
+class ProfileStats(AccumulatorABC):
+    """cProfile statistics of the work items, merged across workers
+
+    ``stats`` is the raw dictionary of a `pstats.Stats`.
+    """
+    def __init__(self, stats=None):
+        self.stats = {} if stats is None else stats
+
+    @classmethod
+    def from_profile(cls, profiler):
+        profiler.create_stats()
+        return cls(profiler.stats)
+
+    def identity(self):
+        return ProfileStats()
+
+    def add(self, other):
+        for func, stat in other.stats.items():
+            self.stats[func] = pstats.add_func_stats(self.stats[func], stat) if func in self.stats else stat
+
+    def to_pstats(self, stream=None):
+        out = pstats.Stats(stream=stream)
+        out.stats = self.stats
+        out.get_top_level_stats()
+        return out
+
+    def report(self, sort='cumulative', limit=40, stream=None):
+        """Print the statistics, sorted by the given key"""
+        self.to_pstats(stream).sort_stats(sort).print_stats(limit)
+
+    def dump(self, path):
+        """Write the statistics to a file readable by pstats, snakeviz, etc."""
+        self.to_pstats().dump_stats(path)
+
+
+class StageTimer(object):
+    """Wall time spent in named stages of a work item
+
+    ``with timer('fill'):`` adds the time spent in the block to the 'fill' stage.
+    `_work_function` passes its timer to process in the ``timer`` entry of its
+    variables, so that processors can break their processing time down.
+    """
+    def __init__(self):
+        self.times = defaultdict_accumulator(float)
+
+    @contextmanager
+    def __call__(self, stage):
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.times[stage] += time.time() - tic
+
+
+@contextmanager
+def _untimed(stage):
+    yield
+
+
+def stage_report(metrics):
+    """Format the per-stage and per-column breakdown of the metrics of a run
+
+    Stages are listed by decreasing time, processor stages being part of 'process'.
+    """
+    lines = []
+    stagetime = metrics.get('stagetime', {})
+    total = sum(t for stage, t in stagetime.items() if stage in ('open', 'read', 'process', 'serialize'))
+    lines.append('%-24s %12s %8s' % ('stage', 'time (s)', 'fraction'))
+    for stage, t in sorted(stagetime.items(), key=lambda x: -x[1]):
+        lines.append('%-24s %12.3f %8.3f' % (stage, t, t / total if total > 0 else 0.))
+    columnbytes = metrics.get('columnbytes', {})
+    columntime = metrics.get('columntime', {})
+    if columnbytes:
+        lines.append('%-24s %12s %12s %10s' % ('column', 'bytes', 'read (s)', 'MB/s'))
+        for name, nbytes in sorted(columnbytes.items(), key=lambda x: -x[1]):
+            t = columntime.get(name, 0.)
+            lines.append('%-24s %12d %12.3f %10.1f' % (name, nbytes, t, nbytes / t / 1e6 if t > 0 else 0.))
+    return '\n'.join(lines)
+
+
+# deserialized processors, kept by each worker thread across work items
+_processor_cache = LRUCache(4)
+
+
+def _load_processor(blob):
+    """Deserialize a compressed processor instance once per worker thread
+
+    Returns the instance, whether it was cached, and how long it took to deserialize
+    """
+    # an instance is only reused by the thread that loaded it, process is not thread-safe
+    key = (threading.get_ident(), hashlib.sha1(blob).digest())
+    cached = key in _processor_cache
+    if cached:
+        # a class pickled by reference has the same blob once its module is reloaded
+        cls = type(_processor_cache[key][0])
+        cached = getattr(sys.modules.get(cls.__module__), cls.__name__, cls) is cls
+    if not cached:
+        tic = time.time()
+        processor_instance = cloudpickle.loads(lz4f.decompress(blob))
+        _processor_cache[key] = (processor_instance, time.time() - tic)
+    processor_instance, loadtime = _processor_cache[key]
+    return processor_instance, cached, loadtime
+
+
+def _open_file(filename, mmap=False):
     if mmap:
         localsource = {}
     else:
@@ -369,23 +1372,238 @@ def _work_function(item, processor_instance, flatten=False, savemetrics=False, m
         def localsource(path):
             return uproot.FileSource(path, **opts)
 
-    file = uproot.open(item.filename, localsource=localsource)
-    tree = file[item.treename]
-    df = LazyDataFrame(tree, item.chunksize, item.index, flatten=flatten)
-    df['dataset'] = item.dataset
-    tic = time.time()
-    out = processor_instance.process(df, locals())
-    toc = time.time()
+    return uproot.open(filename, localsource=localsource)
+
+
+class _FilePool(object):
+    """Open ROOT files and their parsed trees, kept by a worker across work items
+
+    At most ``maxfiles`` files stay open, the least recently used one is closed
+    first.  Local files are reopened once their size or modification time changed,
+    as the pool outlives the job that opened them.  If ``basketbytes`` is set, decoded baskets are shared between work items
+    through the basket cache of the process (see `_process_basket_cache`), so that
+    the pools of all its threads hold at most that many bytes together.
+    """
+    def __init__(self):
+        self.files = OrderedDict()
+        self.basketcache = None
+        self.pid = os.getpid()
+        self._reader = None
+
+    def reader(self):
+        """A thread and a file pool of its own, to read ahead of the thread using this pool"""
+        if self._reader is None:
+            self._reader = concurrent.futures.ThreadPoolExecutor(1), _FilePool()
+        return self._reader
+
+    def open(self, item, mmap=False, maxfiles=4, basketbytes=0):
+        """Return the file and tree of a work item, and whether the file was already open"""
+        key = (item.filename, mmap)
+        stamp = DiskMetadataCache._stamp(item.filename)
+        hit = key in self.files and self.files[key][2] == stamp
+        if hit:
+            self.files.move_to_end(key)
+        else:
+            if key in self.files:
+                self.files.pop(key)[0].source.close()
+            self.files[key] = (_open_file(item.filename, mmap), {}, stamp)
+            while len(self.files) > maxfiles:
+                _, (file, _, _) = self.files.popitem(last=False)
+                file.source.close()
+        file, trees, _ = self.files[key]
+        if item.treename not in trees:
+            trees[item.treename] = file[item.treename]
+        self.basketcache = _process_basket_cache(basketbytes)
+        return file, trees[item.treename], hit
+
+
+_basket_cache_lock = threading.Lock()
+_basket_cache = (None, 0, None)
+
+
+def _process_basket_cache(basketbytes):
+    """The decoded basket cache of this process, shared by the file pools of all its threads"""
+    global _basket_cache
+    with _basket_cache_lock:
+        pid, nbytes, cache = _basket_cache
+        # a forked worker starts with an empty cache of its own
+        if pid != os.getpid() or nbytes != basketbytes:
+            cache = uproot.ThreadSafeArrayCache(basketbytes) if basketbytes else None
+            _basket_cache = (os.getpid(), basketbytes, cache)
+        return cache
+
+
+# one file pool per worker thread, uproot files are not thread-safe
+_file_pools = threading.local()
+
+
+class _ReadAhead(object):
+    """Read the declared columns of the next chunks of a batch in a background thread
+
+    While a chunk is processed, at most ``depth`` of the following ones are read, and only
+    as long as their decoded size, estimated from the chunks read so far, stays below
+    ``maxbytes``; when nothing is in flight the next one is read anyway.  The reader opens
+    the file in its own pool, uproot files are not thread-safe.  ``readtime`` is the time
+    spent reading and ``stalltime`` the time the processing thread waited for it.
+    """
+    def __init__(self, reader, columns, mmap=False, flatten=False, depth=1, maxbytes=1 << 30, columntime=None):
+        self.executor, self.pool = reader
+        self.columns = columns
+        self.mmap = mmap
+        self.flatten = flatten
+        self.depth = depth
+        self.maxbytes = maxbytes
+        self.columntime = columntime
+        self.readtime = self.stalltime = 0.
+        self.bytesread = 0
+        self.entrybytes = None  # decoded bytes per entry of the chunks read so far
+        self.decoded = self.entries = 0
+
+    def _read(self, item, df):
+        tic = time.time()
+        file, tree, _ = self.pool.open(item, self.mmap)
+        bytesread = getattr(file.source, 'bytesread', 0)
+        _prefetch(df, tree, self.columns, self.flatten, self.columntime)
+        return time.time() - tic, getattr(file.source, 'bytesread', 0) - bytesread
+
+    def _estimate(self, df):
+        return 0 if self.entrybytes is None else self.entrybytes * df.size
+
+    def run(self, chunks):
+        """Yield the (item, data frame) of chunks in order, with their columns read"""
+        chunks = deque(chunks)
+        pending = deque()  # (item, df, future, estimated bytes)
+
+        def launch(limit, inflight=0):
+            inflight += sum(estimate for _, _, _, estimate in pending)
+            while chunks and len(pending) < limit:
+                item, df = chunks[0]
+                estimate = self._estimate(df)
+                if pending and inflight + estimate > self.maxbytes:
+                    break
+                chunks.popleft()
+                pending.append((item, df, self.executor.submit(self._read, item, df), estimate))
+                inflight += estimate
+
+        launch(1)
+        while pending:
+            item, df, future, _ = pending.popleft()
+            tic = time.time()
+            readtime, bytesread = future.result()
+            self.stalltime += time.time() - tic
+            self.readtime += readtime
+            self.bytesread += bytesread
+            decoded = sum(getattr(df[name], 'nbytes', 0) for name in df.materialized)
+            self.decoded += decoded
+            self.entries += df.size
+            self.entrybytes = self.decoded / max(self.entries, 1)
+            # the next chunks are read while this one is processed
+            launch(self.depth, decoded)
+            yield item, df
+
+
+def _work_function(item, processor_instance, flatten=False, savemetrics=False, mmap=False, prefetch=True,
+                   filepool=4, basketcache=0, profile=False, readahead_depth=1, readahead_bytes=1 << 30):
+    worktic = time.time()
+    if processor_instance == 'heavy':
+        item, processor_instance = item
+    loads, loadtime, savedtime = 0, 0., 0.
+    if not isinstance(processor_instance, ProcessorABC):
+        processor_instance, cached, loadtime = _load_processor(processor_instance)
+        if cached:
+            loadtime, savedtime = 0., loadtime
+        else:
+            loads = 1
+
+    timer = StageTimer() if savemetrics else _untimed
+    columntime = defaultdict_accumulator(float) if savemetrics else None
+    with timer('open'):
+        if filepool:
+            # a forked worker must not share the file offsets of its parent's open files
+            if getattr(_file_pools, 'pool', None) is None or _file_pools.pool.pid != os.getpid():
+                _file_pools.pool = _FilePool()
+            file, tree, filehit = _file_pools.pool.open(item, mmap, filepool, basketcache)
+        else:
+            file, filehit = _open_file(item.filename, mmap), False
+            tree = file[item.treename]
+    # the source of a pooled file counts the bytes read by all its work items
+    bytesread = getattr(file.source, 'bytesread', 0)
+    batch = item
+    chunks = batch.chunks() if isinstance(batch, _ChunkBatch) else [batch]
+    columns = getattr(processor_instance, 'columns', None) if prefetch else None
+    dfs = []
+    for item in chunks:
+        # LazyDataFrame only takes (stride, index) ranges, set the item's own
+        df = LazyDataFrame(tree, item.numentries, 0, flatten=flatten)
+        df._branchargs.update(entrystart=item.entrystart, entrystop=item.entrystop)
+        if filepool and _file_pools.pool.basketcache is not None:
+            df._branchargs['basketcache'] = _file_pools.pool.basketcache
+        df['dataset'] = item.dataset
+        dfs.append((item, df))
+    reader = readahead = None
+    if columns and len(chunks) > 1:
+        reader = _file_pools.pool.reader() if filepool else (concurrent.futures.ThreadPoolExecutor(1), _FilePool())
+        readahead = _ReadAhead(reader, columns, mmap, flatten, readahead_depth, readahead_bytes, columntime)
+        dfs = readahead.run(dfs)
+    if profile:
+        profiler = cProfile.Profile()
+    out = None
+    processtime = 0.
+    entries = 0
+    materialized = set()
+    for item, df in dfs:
+        if columns and readahead is None:
+            with timer('read'):
+                _prefetch(df, tree, columns, flatten, columntime)
+        if profile:
+            profiler.enable()
+        tic = time.time()
+        with timer('process'):
+            chunk_out = processor_instance.process(df, locals())
+        processtime += time.time() - tic
+        if profile:
+            profiler.disable()
+        if out is None:
+            out = chunk_out
+        else:
+            out += chunk_out
+        entries += df.size
+        materialized.update(df.materialized)
     metrics = dict_accumulator()
+    if profile:
+        metrics['profile'] = ProfileStats.from_profile(profiler)
     if savemetrics:
         if isinstance(file.source, uproot.source.xrootd.XRootDSource):
-            metrics['bytesread'] = value_accumulator(int, file.source.bytesread)
+            readbytes = readahead.bytesread if readahead is not None else 0
+            metrics['bytesread'] = value_accumulator(int, file.source.bytesread - bytesread + readbytes)
             metrics['dataservers'] = set_accumulator({file.source._source.get_property('DataServer')})
-        metrics['columns'] = set_accumulator(df.materialized)
-        metrics['entries'] = value_accumulator(int, df.size)
-        metrics['processtime'] = value_accumulator(float, toc - tic)
+        metrics['columns'] = set_accumulator(materialized)
+        metrics['entries'] = value_accumulator(int, entries)
+        metrics['processtime'] = value_accumulator(float, processtime)
+        # the whole work item: processor load, file open, reads and processing
+        metrics['worktime'] = value_accumulator(float, time.time() - worktic)
+        metrics['processorloads'] = value_accumulator(int, loads)
+        metrics['processorloadtime'] = value_accumulator(float, loadtime)
+        metrics['processorloadtime_saved'] = value_accumulator(float, savedtime)
+        metrics['fileopens'] = value_accumulator(int, 0 if filehit else 1)
+        # the executor adds the 'serialize' stage once the output is sent
+        metrics['stagetime'] = timer.times
+        metrics['columntime'] = columntime
+        metrics['columnbytes'] = defaultdict_accumulator(int, (
+            (name, _branch_bytes(tree[name], batch.entrystart, batch.entrystop)) for name in materialized
+        ))
+        if readahead is not None:
+            # only the time spent waiting for the reader is on the critical path
+            metrics['stagetime']['read'] += readahead.stalltime
+            metrics['readtime'] = value_accumulator(float, readahead.readtime)
+            metrics['readstalltime'] = value_accumulator(float, readahead.stalltime)
     wrapped_out = dict_accumulator({'out': out, 'metrics': metrics})
-    file.source.close()
+    if not filepool:
+        file.source.close()
+        if reader is not None:
+            reader[0].shutdown()
+            for readfile, _, _ in reader[1].files.values():
+                readfile.source.close()
     return wrapped_out
 
 
@@ -404,9 +1622,23 @@ def _normalize_fileset(fileset, treename):
             yield FileMeta(dataset, filename, local_treename)
 
 
-def _get_metadata(item):
-    nentries = uproot.numentries(item.filename, item.treename)
-    return set_accumulator([FileMeta(item.dataset, item.filename, item.treename, nentries)])
+def _executor_workers(executor, executor_args):
+    """How many items the executor processes at once"""
+    if executor is dask_executor and executor_args.get('client') is not None:
+        return max(sum(executor_args['client'].nthreads().values()), 1)
+    return executor_args.get('workers') or 1
+
+
+def _get_metadata(item, clusters=False):
+    if not clusters:
+        nentries = uproot.numentries(item.filename, item.treename)
+        return set_accumulator([FileMeta(item.dataset, item.filename, item.treename, nentries)])
+    file = uproot.open(item.filename)
+    tree = file[item.treename]
+    # numpy integers are not JSON serializable, see DiskMetadataCache
+    boundaries = [int(stop) for start, stop in tree.clusters()]
+    file.source.close()
+    return set_accumulator([FileMeta(item.dataset, item.filename, item.treename, int(tree.numentries), boundaries)])
 
 
 def run_uproot_job(fileset,
@@ -418,7 +1650,10 @@ def run_uproot_job(fileset,
                    pre_args=None,
                    chunksize=200000,
                    maxchunks=None,
-                   metadata_cache=LRUCache(100000)
+                   metadata_cache=LRUCache(100000),
+                   chunktime=None,
+                   align_clusters=False,
+                   checkpoint=None,
                    ):
     '''A tool to run a processor using uproot for data delivery
 
@@ -447,10 +1682,31 @@ def run_uproot_job(fileset,
             Arguments to pass to executor.  See `iterative_executor`,
             `futures_executor`, `dask_executor`, or `parsl_executor` for available options.
             Some options that affect the behavior of this function:
-            'savemetrics' saves some detailed metrics for xrootd processing (default False);
+            'savemetrics' saves some detailed metrics for xrootd processing (default False),
+            and the number of processor deserializations by the workers, their time and the time
+            saved by reusing them, the total time of the work items, the number of files the
+            workers opened, along with the hit rates of the worker file pools and processor caches, the time spent in each stage
+            of the work items (see `StageTimer`) and the bytes and read time of each column,
+            which `stage_report` formats;
             'flatten' removes any jagged structure from the input files (default False);
             'processor_compression' sets the compression level used to send processor instance
-            to workers (default 1).
+            to workers (default 1);
+            'prefetch' reads all the columns listed in the processor's ``columns`` attribute, if any,
+            in one request per chunk before calling process (default True);
+            'filepool' sets how many files each worker keeps open across chunks, the least
+            recently used are closed first, 0 opens and closes the file of every chunk (default 4);
+            'basketcache' sets the size in bytes of a per-process cache of decompressed baskets,
+            shared by the chunks of the open files of all its threads (default 0, no cache);
+            'profile' runs cProfile around process in the workers and merges their statistics:
+            if a path, they are written there as a pstats file, otherwise if true the most expensive
+            calls are printed (default False);
+            'pipeline' sets how many consecutive chunks of a file make one work item, a background
+            thread of the worker reads the columns of the next chunks while the current one is
+            processed, which needs prefetch (default None, one chunk per work item); the 'chunks'
+            metric counts the chunks and 'workitems' the work items, which the hit rates refer to;
+            'readahead' sets how many chunks are read ahead of the one being processed (default 1)
+            and 'readahead_bytes' bounds the estimated size of their columns (default 1 GB), the
+            read and stall times and the overlap ratios are added to the metrics.
         pre_executor : callable
             A function like executor, used to calculate fileset metadata
             Defaults to executor
@@ -461,17 +1717,38 @@ def run_uproot_job(fileset,
         maxchunks : int, optional
             Maximum number of chunks to process per dataset
             Defaults to processing the whole dataset
-        metadata_cache : mapping, optional
+        metadata_cache : mapping or str, optional
             A dict-like object to use as a cache for (file, tree) metadata that is used to
             determine chunking.  Defaults to a in-memory LRU cache that holds 100k entries
             (about 1MB depending on the length of filenames, etc.)  If you edit an input file
             (please don't) during a session, the session can be restarted to clear the cache.
+            A path is opened as a `DiskMetadataCache`, which persists across sessions.
+        chunktime : float, optional
+            Target time per chunk, in seconds.  If set, a first wave of chunks of ``chunksize``
+            entries, at least one per dataset and one per executor worker, is processed to measure
+            the time per entry of each dataset, file opening and reading included, and the remaining
+            entries are split to take about ``chunktime`` each, longest first, with the last
+            wave (one chunk per executor worker) split finer.  Ignored if maxchunks is set.
+        align_clusters : bool, optional
+            Also read the cluster boundaries of each tree during preprocessing (and keep them
+            in the metadata cache), and move every chunk edge to the nearest one, so that each
+            basket is read and decompressed by a single chunk (default False).  A chunk that
+            would be over twice ``chunksize`` is split at the boundaries below ``chunksize``,
+            or within a cluster if that is larger than ``chunksize``
+        checkpoint : str or ResultStore, optional
+            A `ResultStore`, or the directory of one, where the output of each chunk is saved
+            as soon as it completes.  When a chunk of an unchanged file is processed again by
+            the same processor, the saved output is added instead, so an interrupted job resumes
+            where it stopped and a rerun is nearly free.  Chunks are identified by their entry
+            range, so the same chunksize (and align_clusters) should be used.
     '''
     if not isinstance(fileset, Mapping):
         raise ValueError("Expected fileset to be a mapping dataset: list(files)")
     if not isinstance(processor_instance, ProcessorABC):
         raise ValueError("Expected processor_instance to derive from ProcessorABC")
 
+    if isinstance(metadata_cache, str):
+        metadata_cache = DiskMetadataCache(metadata_cache)
     if pre_executor is None:
         pre_executor = executor
     if pre_args is None:
@@ -479,9 +1756,12 @@ def run_uproot_job(fileset,
 
     fileset = list(_normalize_fileset(fileset, treename))
     for filemeta in fileset:
-        filemeta.maybe_populate(metadata_cache)
+        filemeta.maybe_populate(metadata_cache, align_clusters)
+    get_metadata = partial(_get_metadata, clusters=align_clusters)
 
     chunks = []
+    calibration = []
+    remaining = []
     if maxchunks is None:
         # this is a bit of an abuse of map-reduce but ok
         to_get = set(filemeta for filemeta in fileset if not filemeta.populated)
@@ -492,12 +1772,30 @@ def run_uproot_job(fileset,
                 'unit': 'file',
             }
             real_pre_args.update(pre_args)
-            executor(to_get, _get_metadata, out, **real_pre_args)
-            while out:
-                item = out.pop()
-                metadata_cache[item] = item.numentries
+            executor(to_get, get_metadata, out, **real_pre_args)
+            metadata_cache.update((item, item.metadata) for item in out)
             for filemeta in fileset:
-                filemeta.maybe_populate(metadata_cache)
+                filemeta.maybe_populate(metadata_cache, align_clusters)
+        if chunktime is not None:
+            # the first wave measures the cost of each dataset, the rest is chunked after
+            remaining = [[filemeta, 0] for filemeta in fileset]
+            calibrated = set()
+            for entry in remaining:
+                if entry[0].dataset not in calibrated and entry[0].numentries > 0:
+                    calibration.append(next(entry[0].chunks(chunksize)))
+                    calibrated.add(entry[0].dataset)
+                    entry[1] = calibration[-1].entrystop
+            # the workers left take the next chunks of the files in turn, rather than wait
+            workers = _executor_workers(executor, executor_args)
+            while len(calibration) < workers:
+                left = [entry for entry in remaining if entry[1] < entry[0].numentries]
+                if not left:
+                    break
+                for entry in left[:workers - len(calibration)]:
+                    calibration.append(next(entry[0].chunks(chunksize, entry[1])))
+                    entry[1] = calibration[-1].entrystop
+            remaining = [tuple(entry) for entry in remaining]
+            fileset = []
         while fileset:
             filemeta = fileset.pop()
             for chunk in filemeta.chunks(chunksize):
@@ -510,8 +1808,9 @@ def run_uproot_job(fileset,
             if nchunks[filemeta.dataset] >= maxchunks:
                 continue
             if not filemeta.populated:
-                filemeta.numentries = _get_metadata(filemeta).pop().numentries
-                metadata_cache[filemeta] = filemeta.numentries
+                metadata = get_metadata(filemeta).pop()
+                filemeta.numentries, filemeta.clusters = metadata.numentries, metadata.clusters
+                metadata_cache[filemeta] = filemeta.metadata
             for chunk in filemeta.chunks(chunksize):
                 chunks.append(chunk)
                 nchunks[filemeta.dataset] += 1
@@ -522,6 +1821,13 @@ def run_uproot_job(fileset,
     savemetrics = executor_args.pop('savemetrics', False)
     flatten = executor_args.pop('flatten', False)
     mmap = executor_args.pop('mmap', False)
+    prefetch = executor_args.pop('prefetch', True)
+    filepool = executor_args.pop('filepool', 4)
+    basketcache = executor_args.pop('basketcache', 0)
+    profile = executor_args.pop('profile', False)
+    pipeline = executor_args.pop('pipeline', None)
+    readahead = executor_args.pop('readahead', 1)
+    readahead_bytes = executor_args.pop('readahead_bytes', 1 << 30)
     pi_compression = executor_args.pop('processor_compression', 1)
     if pi_compression is None:
         pi_to_send = processor_instance
@@ -535,6 +1841,12 @@ def run_uproot_job(fileset,
                           flatten=flatten,
                           savemetrics=savemetrics,
                           mmap=mmap,
+                          prefetch=prefetch,
+                          filepool=filepool,
+                          basketcache=basketcache,
+                          profile=bool(profile),
+                          readahead_depth=readahead,
+                          readahead_bytes=readahead_bytes,
                           )
     else:
         closure = partial(_work_function,
@@ -542,16 +1854,84 @@ def run_uproot_job(fileset,
                           flatten=flatten,
                           savemetrics=savemetrics,
                           mmap=mmap,
+                          prefetch=prefetch,
+                          filepool=filepool,
+                          basketcache=basketcache,
+                          profile=bool(profile),
+                          readahead_depth=readahead,
+                          readahead_bytes=readahead_bytes,
                           )
 
+    restored = []
+    if checkpoint is not None:
+        if not isinstance(checkpoint, ResultStore):
+            checkpoint = ResultStore(checkpoint)
+        store = checkpoint.bind(_processor_digest(processor_instance))
+        closure = _checkpointed(closure, store)
+
     out = processor_instance.accumulator.identity()
     wrapped_out = dict_accumulator({'out': out, 'metrics': dict_accumulator()})
     exe_args = {
         'unit': 'chunk',
     }
     exe_args.update(executor_args)
+    if calibration:
+        calibrated = dict_accumulator()
+        if checkpoint is not None:
+            done, calibration = store.restore(calibration)
+            for item, result in done:
+                calibrated.add({item.dataset: result})
+            restored.extend(done)
+        executor(calibration, _by_dataset(partial(closure, savemetrics=True)), calibrated,
+                 **dict(exe_args, desc='Calibrating'))
+        cost = {}
+        for dataset, result in calibrated.items():
+            out.add(result['out'])
+            if savemetrics:
+                wrapped_out['metrics'].add(result['metrics'])
+            elif 'profile' in result['metrics']:
+                wrapped_out['metrics'].add({'profile': result['metrics']['profile']})
+            if result['metrics'].get('entries', value_accumulator(int)).value > 0:
+                cost[dataset] = result['metrics']['worktime'].value / result['metrics']['entries'].value
+        chunks = _adaptive_chunks(remaining, cost, chunktime, _executor_workers(executor, executor_args))
+    if pipeline:
+        chunks = _batch_chunks(chunks, pipeline)
+    if checkpoint is not None:
+        done, chunks = store.restore(chunks)
+        for item, result in done:
+            wrapped_out.add(result)
+        restored.extend(done)
     executor(chunks, closure, wrapped_out, **exe_args)
-    wrapped_out['metrics']['chunks'] = value_accumulator(int, len(chunks))
+    workitems = [item for item, _ in restored] + calibration + chunks
+    # a pipelined work item holds several chunks
+    nchunks = sum(len(item.chunks()) if isinstance(item, _ChunkBatch) else 1 for item in workitems)
+    if profile:
+        stats = wrapped_out['metrics'].pop('profile', ProfileStats())
+        if isinstance(profile, str):
+            stats.dump(profile)
+        else:
+            stats.report()
+    if checkpoint is not None:
+        checkpoint.hits += store.hits
+        checkpoint.misses += store.misses
+        checkpoint.evict()
+        wrapped_out['metrics']['storehits'] = value_accumulator(int, store.hits)
+        wrapped_out['metrics']['storemisses'] = value_accumulator(int, store.misses)
+    wrapped_out['metrics']['chunks'] = value_accumulator(int, nchunks)
+    wrapped_out['metrics']['workitems'] = value_accumulator(int, len(workitems))
+    if savemetrics and workitems and 'fileopens' in wrapped_out['metrics']:
+        # files are opened and processors loaded once per work item
+        metrics = wrapped_out['metrics']
+        metrics['filepool_hitrate'] = value_accumulator(float, 1. - metrics['fileopens'].value / len(workitems))
+        if pi_compression is not None:
+            metrics['processorcache_hitrate'] = value_accumulator(
+                float, 1. - metrics['processorloads'].value / len(workitems))
+    if savemetrics and wrapped_out['metrics'].get('readtime', value_accumulator(float)).value > 0:
+        # the share of the read time hidden behind processing, and of the processing time hiding it
+        metrics = wrapped_out['metrics']
+        hidden = metrics['readtime'].value - metrics['readstalltime'].value
+        metrics['readoverlap'] = value_accumulator(float, hidden / metrics['readtime'].value)
+        metrics['processoverlap'] = value_accumulator(float, hidden / metrics['processtime'].value)
     processor_instance.postprocess(out)
     if savemetrics:
         return out, wrapped_out['metrics']
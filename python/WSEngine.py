@@ -0,0 +1,638 @@
+"""
+WSEngine.py
+Selections, weights and histograms of the workspace producers, shared by WSProducer.py
+and python/WSProducer.py.
+"""
+import ast
+import copy
+import operator
+import re
+import time
+from functools import reduce
+
+from coffea.hist import Hist, Bin, export1d
+from coffea.processor import ProcessorABC, AccumulatorABC, LazyDataFrame
+from uproot import recreate
+import numpy as np
+
+try:
+    from coffea.processor.executor import _untimed
+except ImportError:
+    # the official coffea executor passes no stage timer to process
+    from contextlib import nullcontext as _untimed
+
+
+def _and(a, b):
+    """AND of two masks, None passing every event."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a & b
+
+
+class CompiledSelection(object):
+    """
+    A selection dictionary compiled into a graph of column expressions.
+    Each cut is parsed once per systematic suffix and identical subexpressions share a node,
+    so they are evaluated once per chunk whichever cut or region uses them: the value of a node
+    referenced more than once is kept until its last reference used it.
+    Nested regions, written as "self.passbut(event, excut, 'region')", become region references.
+    Other cuts are evaluated as python expressions of event, self, excut and cat, as passbut did;
+    those using self, excut or cat are evaluated by every mask() call.
+    """
+
+    operators = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+        ast.Mod: operator.mod, ast.Pow: operator.pow, ast.BitAnd: operator.and_, ast.BitOr: operator.or_,
+        ast.BitXor: operator.xor, ast.USub: operator.neg, ast.UAdd: operator.pos, ast.Invert: operator.invert,
+        ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+        ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    }
+    functions = {'abs': abs}
+    literals = tuple(getattr(ast, name) for name in ('Constant', 'Num', 'Str') if hasattr(ast, name))
+
+    def __init__(self, selection):
+        self.selection = selection
+        self.nodes = []  # ('column', name), ('const', value), ('eval', source) or (function, *argument nodes)
+        self.programs = {}  # (region, sys) -> [(cut, node or name of a nested region)]
+        self.references = {}  # node -> number of nodes and programs using it
+        self.scoped = set()  # eval nodes using self, excut or cat
+        self._index = {}
+        self._code = {}
+        self._event, self._values, self._pending, self._regions = None, {}, {}, {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_code'], state['_event'] = {}, None
+        state['_values'], state['_pending'], state['_regions'] = {}, {}, {}
+        return state
+
+    def compile(self, sys=''):
+        """
+        Parse every region of the selection for a systematic suffix.  All of them at once, the
+        references of a node must be known before its value is first computed.
+        """
+        for cat in self.selection:
+            if (cat, sys) not in self.programs:
+                self.programs[cat, sys] = [(cut, self._parse(cut.format(sys=sys))) for cut in self.selection[cat]]
+                for cut, node in self.programs[cat, sys]:
+                    if self.direct(node):
+                        self.references[node] = self.references.get(node, 0) + 1
+
+    def program(self, cat, sys=''):
+        if (cat, sys) not in self.programs:
+            self.compile(sys)
+        return self.programs[cat, sys]
+
+    def direct(self, node):
+        """Whether a program entry is a node whose value does not depend on the mask being built."""
+        return not isinstance(node, str) and node not in self.scoped
+
+    @property
+    def columns(self):
+        """Branches read by the compiled cuts."""
+        columns = set()
+        for op, *args in self.nodes:
+            if op == 'column':
+                columns.add(args[0])
+            elif op == 'eval':
+                columns.update(re.findall(r'event\.(\w+)', args[0]))
+        return columns
+
+    def _node(self, *key):
+        if key not in self._index:
+            self._index[key] = len(self.nodes)
+            self.nodes.append(key)
+            if key[0] not in ('column', 'const', 'eval'):
+                for arg in key[1:]:
+                    self.references[arg] = self.references.get(arg, 0) + 1
+        return self._index[key]
+
+    def _parse(self, cut):
+        cut = cut.strip()
+        tree = ast.parse(cut, mode='eval').body
+        if (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Attribute) and tree.func.attr == 'passbut'
+                and len(tree.args) == 3 and isinstance(tree.args[2], self.literals)):
+            return ast.literal_eval(tree.args[2])
+        try:
+            return self._expression(tree)
+        except NotImplementedError:
+            # anything else is kept as a python expression, compiled once per process
+            node = self._node('eval', cut)
+            if {'self', 'excut', 'cat'} & set(self._compiled(node).co_names):
+                self.scoped.add(node)
+            return node
+
+    def _expression(self, node):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'event':
+            return self._node('column', node.attr)
+        if isinstance(node, self.literals) and isinstance(ast.literal_eval(node), (int, float)):
+            return self._node('const', ast.literal_eval(node))
+        if isinstance(node, ast.BinOp) and type(node.op) in self.operators:
+            return self._node(self.operators[type(node.op)], self._expression(node.left), self._expression(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.operators:
+            return self._node(self.operators[type(node.op)], self._expression(node.operand))
+        if isinstance(node, ast.Compare) and all(type(op) in self.operators for op in node.ops):
+            operands = [self._expression(operand) for operand in [node.left] + node.comparators]
+            compared = [self._node(self.operators[type(op)], a, b)
+                        for op, a, b in zip(node.ops, operands, operands[1:])]
+            return reduce(lambda a, b: self._node(operator.and_, a, b), compared)
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.functions
+                and not node.keywords):
+            return self._node(self.functions[node.func.id], *(self._expression(arg) for arg in node.args))
+        raise NotImplementedError(ast.dump(node))
+
+    def _compiled(self, node):
+        if node not in self._code:
+            self._code[node] = compile(self.nodes[node][1], '<selection>', 'eval')
+        return self._code[node]
+
+    def _bind(self, event):
+        if event is not self._event:
+            self._event, self._values, self._pending, self._regions = event, {}, {}, {}
+
+    def value(self, event, node, scope=None):
+        """
+        Value of a graph node for this chunk.  A node referenced more than once is kept until it was
+        used that many times, columns are kept by the data frame.  scope holds the self, excut and cat
+        of the mask being built, for the python expressions using them.
+        """
+        self._bind(event)
+        if node in self._values:
+            value = self._values[node]
+            self._pending[node] -= 1
+            if self._pending[node] <= 0:
+                del self._values[node], self._pending[node]
+            return value
+        op, *args = self.nodes[node]
+        if op == 'column':
+            return event[args[0]]
+        if op == 'const':
+            return args[0]
+        if op == 'eval':
+            value = eval(self._compiled(node), globals(), dict(scope or {}, event=event))
+            if node in self.scoped:
+                return value
+        else:
+            value = op(*(self.value(event, arg) for arg in args))
+        if self.references.get(node, 0) > 1:
+            self._values[node], self._pending[node] = value, self.references[node] - 1
+        return value
+
+    def products(self, event, cat, sys=''):
+        """
+        Masks of the direct cuts of a region, see direct(), with their prefix and suffix AND products:
+        prefix[k] passes cuts[:k] and suffix[k] passes cuts[k:], None standing for no cut at all.
+        They are kept until the region is released, see release().
+        """
+        self._bind(event)
+        region = self._regions.setdefault((cat, sys), {'masks': {}, 'entries': {}})
+        if 'products' not in region:
+            masks = [self.value(event, node) for cut, node in self.program(cat, sys) if self.direct(node)]
+            prefix, suffix = [None], [None]
+            for m in masks:
+                prefix.append(_and(prefix[-1], m))
+            for m in reversed(masks):
+                suffix.append(_and(m, suffix[-1]))
+            region['products'] = masks, prefix, suffix[::-1]
+        return region['products']
+
+    def _allbut(self, event, cat, sys, skip, excut=None, owner=None):
+        """Events passing every cut of a region but the ones at the positions in skip."""
+        masks, prefix, suffix = self.products(event, cat, sys)
+        program = self.program(cat, sys)
+        direct = [k for k, (cut, node) in enumerate(program) if self.direct(node)]
+        excluded = [i for i, k in enumerate(direct) if k in skip]
+        if not excluded:
+            result = prefix[-1]
+        else:
+            result = _and(prefix[excluded[0]], suffix[excluded[-1] + 1])
+            for i in range(excluded[0] + 1, excluded[-1]):
+                if direct[i] not in skip:
+                    result = _and(result, masks[i])
+        for k, (cut, node) in enumerate(program):
+            if k in skip or self.direct(node):
+                continue
+            if isinstance(node, str):
+                result = _and(result, self.mask(event, excut, node, sys, owner))
+            else:
+                result = _and(result, self.value(event, node, {'self': owner, 'excut': excut, 'cat': cat}))
+        return np.ones(event.size, dtype=bool) if result is None else result
+
+    def mask(self, event, excut, cat, sys='', owner=None):
+        """
+        Events passing every cut of a region except those containing excut.
+        owner is the producer seen as self by the cuts evaluated as python expressions.
+        """
+        self._bind(event)
+        masks = self._regions.setdefault((cat, sys), {'masks': {}, 'entries': {}})['masks']
+        if excut not in masks:
+            skip = {k for k, (cut, node) in enumerate(self.program(cat, sys)) if excut is not None and excut in cut}
+            masks[excut] = self._allbut(event, cat, sys, skip, excut, owner)
+        return masks[excut]
+
+    def entries(self, event, excut, cat, sys='', owner=None):
+        """Indices of the events of mask(), computed once per chunk."""
+        mask = self.mask(event, excut, cat, sys, owner)
+        entries = self._regions[cat, sys]['entries']
+        if excut not in entries:
+            entries[excut] = np.flatnonzero(mask)
+        return entries[excut]
+
+    def nminusone(self, event, cat, sys='', owner=None):
+        """For every cut of a region in order, the events passing all the other cuts."""
+        return [self._allbut(event, cat, sys, {k}, owner=owner) for k in range(len(self.program(cat, sys)))]
+
+    def release(self, cat=None, sys=''):
+        """
+        Drop the values computed for the current chunk, or only the cut products, masks and entries of
+        a region, which are computed again if they are asked for again.
+        """
+        if cat is not None:
+            self._regions.pop((cat, sys), None)
+        else:
+            self._event, self._values, self._pending, self._regions = None, {}, {}, {}
+
+
+class BinIndex(object):
+    """
+    Bin numbering of a coffea Bin axis, computed with precomputed edges:
+    0 is the underflow, 1 to n the bins, n + 1 the overflow and n + 2 the nanflow.
+    """
+
+    def __init__(self, n_or_arr, lo=None, hi=None, **kwargs):
+        if isinstance(n_or_arr, int):
+            self.uniform, self.nbins, self.lo, self.hi = True, n_or_arr, float(lo), float(hi)
+            self.edges = np.linspace(self.lo, self.hi, self.nbins + 1)
+        else:
+            self.uniform, self.edges = False, np.array(sorted(n_or_arr), dtype=np.float64)
+            self.nbins, self.lo, self.hi = len(self.edges) - 1, self.edges[0], self.edges[-1]
+        self.size = self.nbins + 3
+
+    def __call__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if self.uniform:
+            with np.errstate(invalid='ignore'):
+                index = np.clip(np.floor((values - self.lo) * float(self.nbins) / (self.hi - self.lo)), -1, self.nbins)
+            index[np.isnan(index)] = -1
+            index = index.astype(np.intp) + 1
+        else:
+            index = np.searchsorted(self.edges, values, side='right')
+        index[np.isnan(values)] = self.nbins + 2
+        return index
+
+
+def _hist_add(hist, sumw, sumw2):
+    """Add bin contents, in BinIndex numbering, to a coffea Hist without sparse axes."""
+    if hist._sumw2 is None:
+        hist._init_sumw2()
+    if () not in hist._sumw:
+        hist._sumw[()] = np.zeros(len(sumw))
+        hist._sumw2[()] = np.zeros(len(sumw2))
+    hist._sumw[()] += sumw
+    hist._sumw2[()] += sumw2
+
+
+class HistogramBlock(AccumulatorABC):
+    """
+    Bin contents of a set of 1D histograms in one contiguous float64 block of shape (2, nbins),
+    sumw then sumw2. Every histogram, i.e. every (histogram, region, systematic), owns the slice
+    layout[name] of the block, flow bins included, in BinIndex numbering.
+    Adding two blocks is a single numpy add and pickling one a single buffer.
+    Indexing by name returns an equivalent coffea Hist.
+    """
+
+    def __init__(self, layout, axes, contents=None):
+        self.layout = layout  # name -> slice of the block
+        self.axes = axes  # name -> coffea Bin arguments
+        if contents is None:
+            contents = np.zeros((2, max((bins.stop for bins in layout.values()), default=0)))
+        self.contents = contents
+
+    def identity(self):
+        return HistogramBlock(self.layout, self.axes)
+
+    def add(self, other):
+        if self.contents.shape != other.contents.shape:
+            raise ValueError(f'cannot add histogram blocks of shapes {self.contents.shape} and {other.contents.shape}')
+        self.contents += other.contents
+
+    def sumw(self, name):
+        return self.contents[0, self.layout[name]]
+
+    def sumw2(self, name):
+        return self.contents[1, self.layout[name]]
+
+    def __len__(self):
+        return len(self.layout)
+
+    def __iter__(self):
+        return iter(self.layout)
+
+    def keys(self):
+        return self.layout.keys()
+
+    def __getitem__(self, name):
+        hist = Hist('Events', Bin(name=name, **self.axes[name]))
+        _hist_add(hist, self.sumw(name), self.sumw2(name))
+        return hist
+
+    def items(self):
+        for name in self.layout:
+            yield name, self[name]
+
+
+def export_histograms(accumulator):
+    """
+    TH1s of every histogram of an accumulator, by name.
+    A HistogramBlock is converted in one pass over the block: the big-endian contents and the TH1
+    statistics of all histograms are computed at once, and each TH1 is a copy of the export1d
+    of the first histogram sharing its axis. Other accumulators of Hist go through export1d.
+    """
+    if not isinstance(accumulator, HistogramBlock):
+        return {name: export1d(hist) for name, hist in accumulator.items()}
+    contents = accumulator.contents.astype('>f8')
+    starts = np.array([bins.start for bins in accumulator.layout.values()], dtype=np.intp)
+    if len(starts) == 0:
+        return {}
+    # bin centers of the inner bins of every histogram, flow bins count as 0
+    inner, centers = np.zeros(contents.shape[1]), np.zeros(contents.shape[1])
+    prototypes = {}
+    for name, bins in accumulator.layout.items():
+        axis = accumulator.axes[name]
+        if id(axis) not in prototypes:
+            edges = BinIndex(**axis).edges
+            prototypes[id(axis)] = export1d(accumulator[name]), (edges[:-1] + edges[1:]) / 2.0
+        inner[bins.start + 1:bins.stop - 2] = 1.
+        centers[bins.start + 1:bins.stop - 2] = prototypes[id(axis)][1]
+    sumw = accumulator.contents[0]
+    tsumw = np.add.reduceat(sumw * inner, starts)
+    tsumwx = np.add.reduceat(sumw * centers, starts)
+    tsumwx2 = np.add.reduceat(sumw * centers ** 2, starts)
+
+    th1s = {}
+    for i, (name, bins) in enumerate(accumulator.layout.items()):
+        th1 = copy.copy(prototypes[id(accumulator.axes[name])][0])
+        th1._fXaxis = copy.copy(th1._fXaxis)
+        th1._fXaxis._fName = name
+        # TH1 holds the underflow, bins and overflow, not the nanflow
+        th1[:] = contents[0, bins.start:bins.stop - 1]
+        th1._fSumw2 = contents[1, bins.start:bins.stop - 1]
+        th1._fEntries = th1._fTsumw = th1._fTsumw2 = tsumw[i]
+        th1._fTsumwx, th1._fTsumwx2 = tsumwx[i], tsumwx2[i]
+        th1s[name] = th1
+    return th1s
+
+
+def write_histograms(path, *accumulators):
+    """Write the histograms of accumulators to a new ROOT file in one batch, and print a timing summary."""
+    tic = time.time()
+    th1s = {}
+    for accumulator in accumulators:
+        th1s.update(export_histograms(accumulator))
+    toc = time.time()
+    f = recreate(path)
+    if hasattr(f, 'update'):
+        f.update(th1s)
+    else:
+        for name, th1 in th1s.items():
+            f[name] = th1
+    f.close()
+    print(f'wrote {len(th1s)} histograms to {path} in {time.time() - tic:.2f}s '
+          f'(export {toc - tic:.2f}s, write {time.time() - toc:.2f}s)')
+    return th1s
+
+
+class WeightTable(object):
+    """
+    Event weights from a declarative table of components:
+        {name: {'nominal': branch, 'up': branch, 'down': branch, 'optional': bool}}
+    The nominal weight is the product of the nominal branches of every component, computed once per chunk.
+    A systematic variation applies to every component whose name is contained in syst_var
+    and is derived from the nominal weight by a single ratio multiply.
+    Missing optional branches are resolved once per file, and count as a factor 1.
+    """
+
+    def __init__(self, components):
+        self.components = components
+        self._files = {}
+        self._event, self._branches, self._nominal = None, None, None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_files'], state['_event'], state['_branches'], state['_nominal'] = {}, None, None, None
+        return state
+
+    def columns(self, syst_vars=('',)):
+        """Branches needed for the nominal weight and the given variations, whether or not they are optional."""
+        columns = {component['nominal'] for component in self.components.values() if 'nominal' in component}
+        for syst_var in syst_vars:
+            direction = 'up' if 'Up' in syst_var else 'down'
+            columns.update(component[direction] for name, component in self.components.items()
+                           if name in syst_var and direction in component)
+        return columns
+
+    def resolve(self, event, key=None):
+        """Branches of every component found in the tree of this chunk, cached by key (e.g. file and tree names)."""
+        if key is None or key not in self._files:
+            available = {b.decode() if isinstance(b, bytes) else b for b in event.available}
+            branches = {}
+            for name, component in self.components.items():
+                for direction in ('nominal', 'up', 'down'):
+                    branch = component.get(direction)
+                    if branch is None:
+                        continue
+                    if branch in available:
+                        branches[name, direction] = branch
+                    elif not component.get('optional', False):
+                        raise KeyError(f"weight branch {branch} doesn't exist")
+            if key is None:
+                self._event, self._branches, self._nominal = event, branches, None
+                return branches
+            self._files[key] = branches
+        if event is not self._event:
+            self._event, self._branches, self._nominal = event, self._files[key], None
+        return self._branches
+
+    def release(self):
+        """Drop the chunk and the nominal weight of the last resolve, the branches of each file are kept."""
+        self._event, self._branches, self._nominal = None, None, None
+
+    def _product(self, event, names, direction='nominal', selec=slice(None)):
+        factors = [event[self._branches[name, direction]][selec] for name in names if (name, direction) in self._branches]
+        return reduce(operator.mul, factors) if factors else None
+
+    def nominal(self, event):
+        if event is not self._event:
+            self.resolve(event)
+        if self._nominal is None:
+            self._nominal = self._product(event, self.components)
+            if self._nominal is None:
+                self._nominal = np.ones(event.size)
+        return self._nominal
+
+    def weight(self, event, syst_var=''):
+        nominal = self.nominal(event)
+        matched = [name for name in self.components if name in syst_var]
+        if not matched:
+            return nominal
+        direction = 'up' if 'Up' in syst_var else 'down'
+        varied = self._product(event, matched, direction)
+        ratio = np.ones(event.size) if varied is None else np.array(varied, dtype=np.float64)
+        denominator = self._product(event, matched)
+        if denominator is None:
+            return nominal * ratio
+        # events with a vanishing nominal factor cannot be rescaled, their weight is recomputed instead
+        vanishing = denominator == 0
+        np.divide(ratio, denominator, out=ratio, where=~vanishing)
+        weight = nominal * ratio
+        if vanishing.any():
+            others = self._product(event, [name for name in self.components if name not in matched], selec=vanishing)
+            weight[vanishing] = ratio[vanishing] * (1 if others is None else others)
+        return weight
+
+
+class WSProducer(ProcessorABC):
+    """
+    A coffea Processor which produces a workspace.
+    This applies selections and produces histograms from kinematics.
+    """
+
+    histograms = NotImplemented
+    selection = NotImplemented
+    weights = NotImplemented
+    data_weights = None  # components of weights applied to data, all of them if None
+    checkpoint_exclude = ('outfile',)  # output paths do not change the stored chunk outputs
+
+    def __init__(self, isMC, era=2017, sample="DY", do_syst=False, syst_var='', weight_syst=False, haddFileName=None, flag=False, systematics=None):
+        self._flag = flag
+        self.do_syst = do_syst
+        self.era = era
+        self.isMC = isMC
+        self.sample = sample
+        self.syst_var, self.syst_suffix = (syst_var, f'_sys_{syst_var}') if do_syst and syst_var else ('', '')
+        self.weight_syst = weight_syst
+        self.cuts = CompiledSelection(self.selection)
+        self.weight_table = None
+        if self.weights is not NotImplemented:
+            self.weight_table = WeightTable({
+                name: component for name, component in self.weights.items()
+                if self.isMC or self.data_weights is None or name in self.data_weights
+            })
+        # (syst_var, weight_syst) pairs filled in the same pass as this producer
+        self.variations = [self.variation(var, wsyst) for var, wsyst in (systematics or [])]
+        for producer in [self] + self.variations:
+            self.cuts.compile(producer.cut_suffix)
+        self.binning = {h: BinIndex(**hist['axis']) for h, hist in self.histograms.items()}
+        layout, axes, nbins = {}, {}, 0
+        for producer in [self] + self.variations:
+            for h, hist in list(self.histograms.items()):
+                for region in hist['region']:
+                    name = producer.naming_schema(hist['name'], region)
+                    if name not in layout:
+                        layout[name], axes[name] = slice(nbins, nbins + self.binning[h].size), hist['axis']
+                        nbins += self.binning[h].size
+        self._accumulator = HistogramBlock(layout, axes)
+        # every branch read by process for the configured systematics, see executor prefetch
+        self.columns = sorted(
+            self.cuts.columns
+            | {hist['target'] for hist in self.histograms.values()}
+            | (self.weight_table.columns([p.syst_var for p in [self] + self.variations]) if self.weight_table else set())
+        )
+        self.outfile = haddFileName
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(era: {self.era}, isMC: {self.isMC}, sample: {self.sample}, do_syst: {self.do_syst}, syst_var: {self.syst_var}, weight_syst: {self.weight_syst}, variations: {len(self.variations)}, output: {self.outfile})'
+
+    def variation(self, syst_var, weight_syst=False):
+        """A copy of this producer configured for a single systematic variation."""
+        producer = copy.copy(self)
+        producer.do_syst = True
+        producer.syst_var, producer.syst_suffix = syst_var, f'_sys_{syst_var}'
+        producer.weight_syst = weight_syst
+        producer.variations = []
+        return producer
+
+    @property
+    def cut_suffix(self):
+        """Systematic suffix of the branches used in the selection, weight variations use the nominal ones."""
+        return '' if self.weight_syst else self.syst_suffix
+
+    @property
+    def accumulator(self):
+        return self._accumulator
+
+    def process(self, df, *args):
+        output = self.accumulator.identity()
+        item = args[0].get('item') if args else None
+        # the executor's stage timer, when it saves metrics
+        timer = args[0].get('timer', _untimed) if args else _untimed
+        try:
+            if self.weight_table is not None and item is not None:
+                self.weight_table.resolve(df, (item.filename, item.treename))
+
+            # the targets are binned once for all regions and variations
+            with timer('binning'):
+                index = {h: self.binning[h](df[hist['target']]) for h, hist in list(self.histograms.items())}
+
+            # columns are cached by df, cuts by self.cuts and the nominal weight is shared by all variations
+            with timer('weighting'):
+                nominal = self.weighting(df)
+            targets, groups = {}, {}
+            for h, hist in list(self.histograms.items()):
+                for region in hist['region']:
+                    if hist['target'] not in targets.setdefault(region, []):
+                        targets[region].append(hist['target'])
+            for producer in [self] + self.variations:
+                groups.setdefault(producer.cut_suffix, []).append(producer)
+            # the variations sharing a cut suffix share the selection, built one region at a time
+            for suffix, producers in groups.items():
+                entries = {}
+                with timer('selection'):
+                    for region in targets:
+                        for target in targets[region]:
+                            entries[target, region] = self.cuts.entries(df, target, region, suffix, producers[0])
+                        # the region's n-1 masks are built, its cut products are no longer needed
+                        self.cuts.release(region, suffix)
+                for producer in producers:
+                    weight = nominal
+                    if producer is not self and producer.weight_syst:
+                        with timer('weighting'):
+                            weight = producer.weighting(df)
+                    for h, hist in list(self.histograms.items()):
+                        for region in hist['region']:
+                            selected = entries[hist['target'], region]
+                            with timer('fill'):
+                                bins, w = index[h].take(selected), np.take(weight, selected)
+                                layout = output.layout[producer.naming_schema(hist['name'], region)]
+                                output.contents[0, layout] += np.bincount(bins, weights=w,
+                                                                          minlength=layout.stop - layout.start)
+                                output.contents[1, layout] += np.bincount(bins, weights=w * w,
+                                                                          minlength=layout.stop - layout.start)
+        finally:
+            # the processor outlives the chunk in the worker processor cache, its columns must not
+            self.cuts.release()
+            if self.weight_table is not None:
+                self.weight_table.release()
+
+        return output
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+    def passbut(self, event: LazyDataFrame, excut: str, cat: str):
+        """Pass all cuts of a region except those containing excut."""
+        return self.cuts.mask(event, excut, cat, self.cut_suffix, self)
+
+    def nminusone(self, event: LazyDataFrame, cat: str):
+        """N-1 masks of a region: for every cut, the events passing all the other cuts."""
+        return dict(zip(self.selection[cat], self.cuts.nminusone(event, cat, self.cut_suffix, self)))
+
+    def weighting(self, event: LazyDataFrame):
+        if self.weight_table is None:
+            return NotImplemented
+        return self.weight_table.weight(event, self.syst_var)
+
+    def naming_schema(self, *args):
+        return NotImplemented
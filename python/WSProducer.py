@@ -1,67 +1,10 @@
 """
 WSProducer.py
 Workspace producers using coffea.
+The selection, weighting and histogram engine is WSEngine.py.
 """
-from coffea.hist import Hist, Bin, export1d
-from coffea.processor import ProcessorABC, LazyDataFrame, dict_accumulator
-from uproot import recreate
-import numpy as np
+from PhysicsTools.MonoZ.WSEngine import *
 
-class WSProducer(ProcessorABC):
-    """
-    A coffea Processor which produces a workspace.
-    This applies selections and produces histograms from kinematics.
-    """
-
-    histograms = NotImplemented
-    selection = NotImplemented
-
-    def __init__(self, isMC, era=2017, sample="DY", do_syst=False, syst_var='', weight_syst=False, haddFileName=None, flag=False):
-        self._flag = flag
-        self.do_syst = do_syst
-        self.era = era
-        self.isMC = isMC
-        self.sample = sample
-        self.syst_var, self.syst_suffix = (syst_var, f'_sys_{syst_var}') if do_syst and syst_var else ('', '')
-        self.weight_syst = weight_syst
-        self._accumulator = dict_accumulator({
-            name: Hist('Events', Bin(name=name, **axis))
-            for name, axis in ((self.naming_schema(hist['name'], region), hist['axis'])
-                               for _, hist in list(self.histograms.items())
-                               for region in hist['region'])
-        })
-        self.outfile = haddFileName
-
-    def __repr__(self):
-        return f'{self.__class__.__name__}(era: {self.era}, isMC: {self.isMC}, sample: {self.sample}, do_syst: {self.do_syst}, syst_var: {self.syst_var}, weight_syst: {self.weight_syst}, output: {self.outfile})'
-
-    @property
-    def accumulator(self):
-        return self._accumulator
-
-    def process(self, df, *args):
-        output = self.accumulator.identity()
-
-        weight = self.weighting(df)
-
-        for h, hist in list(self.histograms.items()):
-            for region in hist['region']:
-                name = self.naming_schema(hist['name'], region)
-                selec = self.passbut(df, hist['target'], region)
-                output[name].fill(**{
-                    'weight': weight[selec],
-                    name: df[hist['target']][selec].flatten()
-                })
-
-        return output
-
-    def postprocess(self, accumulator):
-        return accumulator
-
-    def passbut(self, event: LazyDataFrame, excut: str, cat: str):
-        """Backwards-compatible passbut."""
-        return eval('&'.join('(' + cut.format(sys=('' if self.weight_syst else self.syst_suffix)) + ')'
-                             for cut in self.selection[cat] if excut not in cut))
 
 class MonoZ(WSProducer):
     histograms = {
@@ -187,131 +130,26 @@ class MonoZ(WSProducer):
         }
 
 
-    def weighting(self, event: LazyDataFrame):
-        weight = 1.0
-        try:
-            weight = event.xsecscale
-        except:
-            return "ERROR: weight branch doesn't exist"
-
-        if self.isMC:
-            try:
-                if "ADD" in self.syst_suffix:
-                    weight *= event.ADDWeight #for ADD samples only (EFT weights)
-            except:
-                pass
-            # weight *= event.genWeight
-            if "puWeight" in self.syst_suffix:
-                if "Up" in self.syst_suffix:
-                    weight *= event.puWeightUp
-                else:
-                    weight *= event.puWeightDown
-            else:
-            	weight *= event.puWeight
-            # Electroweak
-            try:
-                if "EWK" in self.syst_suffix:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.kEWUp
-                    else:
-                        weight *= event.kEWDown
-                else:
-                    weight *= event.kEW
-            except:
-                pass
-            # NNLO crrection
-            try:
-                weight *= event.kNNLO
-            except:
-                pass
-            # PDF uncertainty
-            if "PDF" in self.syst_suffix:
-                try:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.pdfw_Up
-                    else:
-                        weight *= event.pdfw_Down
-                except:
-                    pass
-            # QCD Scale weights
-            if "QCDScale0" in self.syst_suffix:
-                try:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.QCDScale0wUp
-                    else:
-                        weight *= event.QCDScale0wDown
-                except:
-                    pass
-            if "QCDScale1" in self.syst_suffix:
-                try:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.QCDScale1wUp
-                    else:
-                        weight *= event.QCDScale1wDown
-                except:
-                    pass
-            if "QCDScale2" in self.syst_suffix:
-                try:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.QCDScale2wUp
-                    else:
-                        weight *= event.QCDScale2wDown
-                except:
-                    pass                
-            #Muon SF    
-            if "MuonSF" in self.syst_suffix:
-                if "Up" in self.syst_suffix:
-                    weight *= event.w_muon_SFUp
-                else:
-                    weight *= event.w_muon_SFDown
-            else:
-                weight *= event.w_muon_SF
-            # Electron SF
-            if "ElecronSF" in self.syst_suffix:
-                if "Up" in self.syst_suffix:
-                    weight *= event.w_electron_SFUp
-                else:
-                    weight *= event.w_electron_SFDown
-            else:
-                weight *= event.w_electron_SF
-	    #Prefire Weight
-            try:
-                if "PrefireWeight" in self.syst_suffix:
-                    if "Up" in self.syst_suffix:
-                        weight *= event.PrefireWeight_Up
-                    else:
-                        weight *= event.PrefireWeight_Down
-                else:
-                    weight *= event.PrefireWeight
-            except:
-                pass
-            #nvtx Weight (replaced by PhiXY corrections)
-            #if "nvtxWeight" in self.syst_suffix:
-            #    if "Up" in self.syst_suffix:
-            #        weight *= event.nvtxWeightUp
-            #    else:
-            #        weight *= event.nvtxWeightDown
-            #else:
-            #    weight *= event.nvtxWeight
-
-            #TriggerSFWeight
-            if "TriggerSFWeight" in self.syst_suffix:
-                if "Up" in self.syst_suffix:
-                    weight *= event.TriggerSFWeightUp
-                else:
-                    weight *= event.TriggerSFWeightDown
-            else:
-                weight *= event.TriggerSFWeight
-            #BTagEventWeight
-            if "btagEventWeight" in self.syst_suffix:
-                if "Up" in self.syst_suffix:
-                    weight *= event.btagEventWeightUp
-                else:
-                    weight *= event.btagEventWeightDown
-            else:
-                weight *= event.btagEventWeight
-
-        return weight
+    data_weights = ['xsecscale']
+    weights = {
+            'xsecscale': {'nominal': 'xsecscale'},
+            'ADD': {'up': 'ADDWeight', 'down': 'ADDWeight', 'optional': True},  # for ADD samples only (EFT weights)
+            'puWeight': {'nominal': 'puWeight', 'up': 'puWeightUp', 'down': 'puWeightDown'},
+            'EWK': {'nominal': 'kEW', 'up': 'kEWUp', 'down': 'kEWDown', 'optional': True},
+            'kNNLO': {'nominal': 'kNNLO', 'optional': True},
+            'PDF': {'up': 'pdfw_Up', 'down': 'pdfw_Down', 'optional': True},
+            'QCDScale0': {'up': 'QCDScale0wUp', 'down': 'QCDScale0wDown', 'optional': True},
+            'QCDScale1': {'up': 'QCDScale1wUp', 'down': 'QCDScale1wDown', 'optional': True},
+            'QCDScale2': {'up': 'QCDScale2wUp', 'down': 'QCDScale2wDown', 'optional': True},
+            'MuonSF': {'nominal': 'w_muon_SF', 'up': 'w_muon_SFUp', 'down': 'w_muon_SFDown'},
+            'ElecronSF': {'nominal': 'w_electron_SF', 'up': 'w_electron_SFUp', 'down': 'w_electron_SFDown'},
+            'PrefireWeight': {'nominal': 'PrefireWeight', 'up': 'PrefireWeight_Up', 'down': 'PrefireWeight_Down',
+                              'optional': True},
+            # nvtx Weight (replaced by PhiXY corrections)
+            # 'nvtxWeight': {'nominal': 'nvtxWeight', 'up': 'nvtxWeightUp', 'down': 'nvtxWeightDown'},
+            'TriggerSFWeight': {'nominal': 'TriggerSFWeight', 'up': 'TriggerSFWeightUp', 'down': 'TriggerSFWeightDown'},
+            'btagEventWeight': {'nominal': 'btagEventWeight', 'up': 'btagEventWeightUp', 'down': 'btagEventWeightDown'},
+        }
 
     def naming_schema(self, name, region):
         return f'{name}_{self.sample}_{region}{self.syst_suffix}'
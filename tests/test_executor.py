@@ -0,0 +1,132 @@
+import numpy as np
+import uproot
+
+from coffea.processor import ProcessorABC, dict_accumulator, value_accumulator
+from coffea.processor.executor import iterative_executor, run_uproot_job
+
+
+class SumX(ProcessorABC):
+    columns = ['x']
+
+    def __init__(self):
+        self._accumulator = dict_accumulator({
+            'entries': value_accumulator(int),
+            'sumx': value_accumulator(float),
+        })
+
+    @property
+    def accumulator(self):
+        return self._accumulator
+
+    def process(self, df, *args):
+        out = self.accumulator.identity()
+        out['entries'] += df.size
+        out['sumx'] += float(np.sum(df['x']))
+        return out
+
+    def postprocess(self, accumulator):
+        return accumulator
+
+
+def _write_tree(path, x, basket=300):
+    with uproot.recreate(path) as f:
+        f['Events'] = uproot.newtree({'x': 'float64'})
+        for start in range(0, len(x), basket):
+            f['Events'].extend({'x': np.asarray(x[start:start + basket], dtype=np.float64)})
+
+
+def test_rewritten_file_is_reopened(tmp_path):
+    path = str(tmp_path / 'events.root')
+    cache = str(tmp_path / 'metadata.sqlite')
+    _write_tree(path, np.ones(1000))
+    out = run_uproot_job({'dataset': [path]}, 'Events', SumX(), iterative_executor, {'status': False},
+                         chunksize=400, metadata_cache=cache)
+    assert out['sumx'].value == 1000.
+
+    # the worker file pool of this process still holds the first file
+    _write_tree(path, np.full(2000, 2.))
+    out = run_uproot_job({'dataset': [path]}, 'Events', SumX(), iterative_executor, {'status': False},
+                         chunksize=400, metadata_cache=cache)
+    assert out['entries'].value == 2000
+    assert out['sumx'].value == 4000.
+
+
+SCALED = '''
+import numpy as np
+from test_executor import SumX
+
+
+class Scaled(SumX):
+    checkpoint_exclude = ('outfile',)
+
+    def __init__(self, outfile):
+        super(Scaled, self).__init__()
+        self.outfile = outfile
+
+    def process(self, df, *args):
+        out = super(Scaled, self).process(df, *args)
+        out['sumx'].value *= {factor}
+        return out
+'''
+
+
+def test_checkpoint_follows_processor_code(tmp_path, monkeypatch):
+    import importlib
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr('sys.dont_write_bytecode', True)
+    path = str(tmp_path / 'events.root')
+    _write_tree(path, np.ones(1000))
+    store = str(tmp_path / 'store')
+
+    def run(processor_instance):
+        return run_uproot_job({'dataset': [path]}, 'Events', processor_instance, iterative_executor,
+                              {'status': False, 'savemetrics': True}, chunksize=400, checkpoint=store)
+
+    (tmp_path / 'scaled.py').write_text(SCALED.format(factor=1))
+    import scaled
+    out, metrics = run(scaled.Scaled('first.root'))
+    assert out['sumx'].value == 1000. and metrics['storehits'].value == 0
+    # an output path is not part of the stored outputs
+    out, metrics = run(scaled.Scaled('second.root'))
+    assert out['sumx'].value == 1000. and metrics['storemisses'].value == 0
+
+    # the class is pickled by reference, editing its module must still invalidate the store
+    (tmp_path / 'scaled.py').write_text(SCALED.format(factor=20))
+    scaled = importlib.reload(scaled)
+    out, metrics = run(scaled.Scaled('first.root'))
+    assert out['sumx'].value == 20000. and metrics['storehits'].value == 0
+
+
+def test_pipelined_chunk_count(tmp_path):
+    path = str(tmp_path / 'events.root')
+    _write_tree(path, np.ones(1000))
+    out, metrics = run_uproot_job({'dataset': [path]}, 'Events', SumX(), iterative_executor,
+                                  {'status': False, 'savemetrics': True, 'pipeline': 3}, chunksize=100)
+    assert out['entries'].value == 1000
+    assert metrics['chunks'].value == 10
+    assert metrics['workitems'].value == 4
+    assert 0. <= metrics['filepool_hitrate'].value <= 1.
+    assert 0. <= metrics['processorcache_hitrate'].value <= 1.
+
+
+def test_pipelined_output_matches(tmp_path):
+    paths = [str(tmp_path / ('events%d.root' % i)) for i in range(2)]
+    for i, path in enumerate(paths):
+        _write_tree(path, np.arange(1234 + 500 * i, dtype=np.float64))
+
+    def run(**executor_args):
+        executor_args.update(status=False)
+        return run_uproot_job({'dataset': paths}, 'Events', SumX(), iterative_executor, executor_args, chunksize=170)
+
+    out, pipelined = run(), run(pipeline=4)
+    assert pipelined['entries'].value == out['entries'].value == 1234 + 1734
+    assert pipelined['sumx'].value == out['sumx'].value
+
+
+def test_aligned_job_reads_every_entry_once(tmp_path):
+    path = str(tmp_path / 'events.root')
+    _write_tree(path, np.arange(5000, dtype=np.float64))
+    out = run_uproot_job({'dataset': [path]}, 'Events', SumX(), iterative_executor, {'status': False},
+                         chunksize=700, align_clusters=True, metadata_cache=str(tmp_path / 'metadata.sqlite'))
+    assert out['entries'].value == 5000
+    assert out['sumx'].value == np.arange(5000).sum()
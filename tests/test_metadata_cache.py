@@ -0,0 +1,52 @@
+import numpy as np
+import uproot
+
+from coffea.processor.executor import DiskMetadataCache, FileMeta, _get_metadata
+
+
+def _write_tree(path, nevents=1000, basket=300):
+    with uproot.recreate(path) as f:
+        f['Events'] = uproot.newtree({'x': 'float32'})
+        for start in range(0, nevents, basket):
+            f['Events'].extend({'x': np.zeros(min(basket, nevents - start), dtype=np.float32)})
+
+
+def test_cluster_metadata_roundtrip(tmp_path):
+    path = str(tmp_path / 'clusters.root')
+    _write_tree(path)
+    filemeta, = _get_metadata(FileMeta('dataset', path, 'Events'), clusters=True)
+    assert filemeta.numentries == 1000
+    assert filemeta.clusters[-1] == 1000
+
+    cache = DiskMetadataCache(str(tmp_path / 'metadata.sqlite'))
+    cache.update([(filemeta, filemeta.metadata)])
+
+    restored = FileMeta('dataset', path, 'Events')
+    restored.maybe_populate(cache, clusters=True)
+    assert restored.populated
+    assert restored.numentries == filemeta.numentries
+    assert restored.clusters == filemeta.clusters
+
+
+def test_cached_clusters_unused_without_align(tmp_path):
+    path = str(tmp_path / 'clusters.root')
+    _write_tree(path)
+    filemeta, = _get_metadata(FileMeta('dataset', path, 'Events'), clusters=True)
+    cache = DiskMetadataCache(str(tmp_path / 'metadata.sqlite'))
+    cache.update([(filemeta, filemeta.metadata)])
+
+    restored = FileMeta('dataset', path, 'Events')
+    restored.maybe_populate(cache, clusters=False)
+    assert restored.numentries == 1000
+    assert restored.clusters is None
+    assert len(list(restored.chunks(100))) == 10
+
+
+def test_aligned_chunks_are_bounded():
+    # a first small cluster, then large ones
+    filemeta = FileMeta('dataset', 'file.root', 'Events', 10000, [100, 5000, 10000])
+    chunks = list(filemeta.chunks(1000))
+    assert chunks[0].entrystart == 0 and chunks[-1].entrystop == 10000
+    assert all(a.entrystop == b.entrystart for a, b in zip(chunks[:-1], chunks[1:]))
+    assert max(chunk.numentries for chunk in chunks) <= 2 * 1000
+    assert {100, 5000} <= {chunk.entrystop for chunk in chunks}
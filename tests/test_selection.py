@@ -0,0 +1,69 @@
+import numpy as np
+
+from python.WSEngine import CompiledSelection
+
+
+class Event(dict):
+    __getattr__ = dict.__getitem__
+
+    @property
+    def size(self):
+        return len(self['x'])
+
+
+class Producer(object):
+    threshold = 0.2
+
+    def __init__(self, selection):
+        self.selection = selection
+        self.cuts = CompiledSelection(selection)
+
+    def passbut(self, event, excut, cat):
+        return self.cuts.mask(event, excut, cat, '', self)
+
+    def reference(self, event, excut, cat):
+        # the selection as passbut evaluated it before it was compiled
+        return eval('&'.join('(%s)' % cut for cut in self.selection[cat] if excut not in cut))
+
+
+SELECTION = {
+    'inclusive': ['event.x > 0.1', 'event.y < 0.9'],
+    'signal': [
+        'event.x > 0.1',
+        'event.y < 0.9',
+        'event.z > self.threshold',
+        "(excut == 'event.w') | (event.w > 0.5)",
+    ],
+    'nested': ["self.passbut(event, excut, 'signal')", 'event.w < 0.8'],
+}
+
+
+def _event(n=1000):
+    rng = np.random.RandomState(42)
+    return Event((name, rng.uniform(size=n)) for name in 'xyzw')
+
+
+def test_masks_match_python_selection():
+    producer, event = Producer(SELECTION), _event()
+    for cat, cuts in SELECTION.items():
+        for excut in [None, 'event.x', 'event.w']:
+            expected = producer.reference(event, excut or '@', cat)
+            np.testing.assert_array_equal(producer.passbut(event, excut, cat), expected)
+
+
+def test_shared_nodes_only_are_kept():
+    producer, event = Producer(SELECTION), _event()
+    for cat in SELECTION:
+        producer.passbut(event, None, cat)
+    # every node used more than once was used as often as it is referenced
+    assert not [node for node in producer.cuts._values if isinstance(node, int)]
+    producer.cuts.release()
+    assert not producer.cuts._values
+
+
+def test_released_region_is_rebuilt():
+    producer, event = Producer(SELECTION), _event()
+    before = producer.cuts.entries(event, 'event.w', 'signal', '', producer)
+    producer.cuts.release('signal')
+    assert ('signal', '') not in producer.cuts._regions
+    np.testing.assert_array_equal(producer.cuts.entries(event, 'event.w', 'signal', '', producer), before)